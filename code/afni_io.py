@@ -0,0 +1,104 @@
+import numpy as np
+
+
+# Read non-comment text from an AFNI 1D file
+def _read_1D_text(fn):
+    with open(fn) as f:
+        lines = [line for line in f.read().splitlines()
+                 if line.strip() and '#' not in line]
+    return lines
+
+
+# Function to load AFNI's 3dTproject 1D outputs as np.ndarray
+def load_1D(fn):
+    """Load a single-row AFNI 1D time series (skipping comment lines)
+
+    Parameters
+    ----------
+    fn : str
+        AFNI 1D filename (e.g. 3dTproject output)
+
+    Returns
+    -------
+    np.ndarray
+        Time series values
+
+    """
+    lines = _read_1D_text(fn)
+    assert len(lines) == 1
+    return np.fromstring(lines[0], dtype=float, sep=' ')
+
+
+# Function to load a multi-column AFNI 1D file (e.g. model regressors)
+def load_1D_matrix(fn, dtype=np.float64):
+    """Load an AFNI 1D file with one row per TR and one column per variable
+
+    Parameters
+    ----------
+    fn : str
+        AFNI 1D filename (e.g. *_desc-model_regressors.1D)
+    dtype : np.dtype, default: np.float64
+        Precision of returned data
+
+    Returns
+    -------
+    np.ndarray
+        Values as (rows x columns), even for a single column
+
+    """
+    return np.loadtxt(fn, dtype=dtype, comments='#', ndmin=2)
+
+
+# Function to write np.ndarray as a single-row AFNI 1D file
+def write_1D(data, output_fn, fmt='%f'):
+    """Write a time series to a single-row AFNI 1D file
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Time series values
+    output_fn : str
+        Output 1D filename
+    fmt : str, default: '%f'
+        Number format passed to np.savetxt
+
+    """
+    np.savetxt(output_fn, np.asarray(data).reshape(1, -1),
+               delimiter=' ', fmt=fmt)
+
+
+# Function to load many 1D time series into one preallocated matrix
+def load_1D_batch(fns, dtype=np.float64):
+    """Load single-row AFNI 1D files into a (TRs x files) matrix
+
+    Parameters
+    ----------
+    fns : list of str
+        AFNI 1D filenames (e.g. all ROI time series for a task)
+    dtype : np.dtype, default: np.float64
+        Precision of returned data
+
+    Returns
+    -------
+    np.ndarray
+        Time series for each file as columns (TRs x files)
+
+    """
+    data = None
+    for i, fn in enumerate(fns):
+        lines = _read_1D_text(fn)
+        assert len(lines) == 1
+        if data is None:
+            first = np.fromstring(lines[0], dtype=dtype, sep=' ')
+            data = np.empty((len(first), len(fns)), dtype=dtype)
+            data[:, 0] = first
+        else:
+            column = np.fromstring(lines[0], dtype=dtype, sep=' ')
+            if len(column) != data.shape[0]:
+                raise ValueError(f"Expected {data.shape[0]} TRs but got "
+                                 f"{len(column)} in {fn}")
+            data[:, i] = column
+    if data is None:
+        return np.empty((0, 0), dtype=dtype)
+    return data
+
@@ -0,0 +1,290 @@
+from os.path import basename
+import hashlib
+import numpy as np
+from numpy.polynomial.legendre import legvander
+from scipy.linalg import qr
+import nibabel as nib
+from afni_io import load_1D, load_1D_batch, load_1D_matrix, write_1D
+from gifti_io import read_gifti, write_gifti
+
+
+# Function to get Legendre polynomial trends (as in AFNI's -polort)
+def legendre_trends(n_TRs, polort=2):
+    """Legendre polynomials up to degree polort over the scan
+
+    Parameters
+    ----------
+    n_TRs : int
+        Number of TRs
+    polort : int, default: 2
+        Maximum polynomial degree (0 is the constant term)
+
+    Returns
+    -------
+    np.ndarray
+        Polynomial trends (TRs x polort + 1)
+
+    """
+    return legvander(np.linspace(-1, 1, n_TRs), polort)
+
+
+# Function to build the confound design matrix for a scan
+def design_matrix(model_fn, n_TRs, polort=2):
+    """Model regressors plus Legendre trends (as in 3dTproject -ort/-polort)
+
+    Parameters
+    ----------
+    model_fn : str
+        Model regressors 1D file with one column per confound (e.g.
+        *_desc-model_regressors.1D from extract_confounds.py)
+    n_TRs : int
+        Number of TRs in the scan
+    polort : int, default: 2
+        Maximum Legendre polynomial degree
+
+    Returns
+    -------
+    np.ndarray
+        Design matrix (TRs x regressors)
+
+    """
+    regressors = load_1D_matrix(model_fn)
+    if regressors.shape[0] != n_TRs:
+        raise ValueError(f"{basename(model_fn)} has {regressors.shape[0]} "
+                         f"rows but data has {n_TRs} TRs")
+    return np.column_stack((legendre_trends(n_TRs, polort), regressors))
+
+
+# Function to get an orthonormal basis for the design (via one QR)
+def design_basis(design, tolerance=1e-10):
+    """Orthonormal basis spanning the columns of a design matrix
+
+    A column-pivoted QR factorization is used so that redundant
+    (collinear) regressors are dropped rather than removing extra
+    variance from the data.
+
+    Parameters
+    ----------
+    design : np.ndarray
+        Design matrix (TRs x regressors)
+    tolerance : float, default: 1e-10
+        Relative threshold on the diagonal of R for dropping columns
+
+    Returns
+    -------
+    np.ndarray
+        Orthonormal basis (TRs x rank)
+
+    """
+    basis, r, _ = qr(design, mode='economic', pivoting=True)
+    diagonal = np.abs(np.diag(r))
+    rank = np.sum(diagonal > tolerance * diagonal[0])
+    if rank < design.shape[1]:
+        print(f"Dropping {design.shape[1] - rank} redundant regressor(s)")
+    return basis[:, :rank]
+
+
+# Cache of design bases keyed by regressor file hash, TRs and polort
+basis_cache = {}
+
+
+# Function to get a (cached) design basis for a model regressors file
+def cached_basis(model_fn, n_TRs, polort=2):
+    """Design basis for a scan, factorized once per regressor file
+
+    Bases are cached in memory keyed by a hash of the regressor file
+    contents (plus the number of TRs and polort), so every target
+    sharing a run's confound model (both hemispheres, the volume and
+    each ROI time series) reuses one QR factorization.
+
+    Parameters
+    ----------
+    model_fn : str
+        Model regressors 1D file (e.g. *_desc-model_regressors.1D)
+    n_TRs : int
+        Number of TRs in the scan
+    polort : int, default: 2
+        Maximum Legendre polynomial degree
+
+    Returns
+    -------
+    np.ndarray
+        Orthonormal basis (TRs x rank)
+
+    """
+    with open(model_fn, 'rb') as f:
+        key = (hashlib.sha1(f.read()).hexdigest(), n_TRs, polort)
+    if key not in basis_cache:
+        basis_cache[key] = design_basis(design_matrix(model_fn, n_TRs,
+                                                      polort=polort))
+    return basis_cache[key]
+
+
+# Function to project confounds out of (TRs x voxels) data
+def regress_out(data, basis):
+    """Residuals of data after projecting out a design basis
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Time series data (TRs x voxels) or (TRs)
+    basis : np.ndarray
+        Orthonormal basis returned by design_basis
+
+    Returns
+    -------
+    np.ndarray
+        Residual time series (same shape as data)
+
+    """
+    data = np.asarray(data, dtype=np.float64)
+    return data - basis @ (basis.T @ data)
+
+
+# Function to load time series as (TRs x voxels) from GIfTI, 1D or NIfTI
+def load_bold(bold_fn, mask_fn=None):
+    """Load surface, ROI or volumetric time series as (TRs x voxels)
+
+    Parameters
+    ----------
+    bold_fn : str
+        GIfTI (.func.gii), single-row AFNI 1D (.1D) or NIfTI file
+    mask_fn : str, optional
+        Volumetric mask (NIfTI only); voxels outside are left out
+
+    Returns
+    -------
+    data : np.ndarray
+        Time series (TRs x voxels)
+    image : dict
+        Information needed by save_clean to write matching output
+
+    """
+    if bold_fn.endswith('.gii'):
+        return read_gifti(bold_fn), {'template_fn': bold_fn}
+    elif bold_fn.endswith('.1D'):
+        return load_1D(bold_fn)[:, np.newaxis], {}
+
+    bold_img = nib.load(bold_fn)
+    bold_data = np.asanyarray(bold_img.dataobj, dtype=np.float32)
+    if mask_fn:
+        mask = np.asanyarray(nib.load(mask_fn).dataobj) > 0
+    else:
+        mask = np.ones(bold_data.shape[:3], dtype=bool)
+    return bold_data[mask].T, {'image': bold_img, 'mask': mask}
+
+
+# Function to save cleaned (TRs x voxels) time series like the input
+def save_clean(clean_data, clean_fn, image):
+    """Save cleaned time series in the format of the input (see load_bold)
+
+    Parameters
+    ----------
+    clean_data : np.ndarray
+        Cleaned time series (TRs x voxels)
+    clean_fn : str
+        Output filename (.func.gii, .1D or NIfTI)
+    image : dict
+        Information returned by load_bold for the input file
+
+    """
+    clean_data = clean_data.astype(np.float32)
+    if clean_fn.endswith('.gii'):
+        write_gifti(clean_data, clean_fn, image['template_fn'],
+                    split_rows=True)
+    elif clean_fn.endswith('.1D'):
+        write_1D(clean_data[:, 0], clean_fn)
+    else:
+        mask = image['mask']
+        volume = np.zeros(mask.shape + (clean_data.shape[0],),
+                          dtype=np.float32)
+        volume[mask] = clean_data.T
+        header = image['image'].header.copy()
+        header.set_data_dtype(np.float32)
+        nib.save(nib.Nifti1Image(volume, image['image'].affine, header),
+                 clean_fn)
+
+
+# Function to regress confounds out of one scan and save the result
+def clean_scan(bold_fn, model_fn, clean_fn, polort=2, mask_fn=None):
+    """Confound regression in NumPy replacing AFNI's 3dTproject
+
+    Equivalent to ``3dTproject -input bold_fn -ort model_fn -polort 2
+    -prefix clean_fn [-mask mask_fn]``: the model regressors and
+    Legendre trends are projected out of every vertex (or voxel) at
+    once using a single QR factorization of the design matrix.
+
+    Parameters
+    ----------
+    bold_fn : str
+        Input GIfTI (.func.gii), single-row AFNI 1D (.1D) or NIfTI file
+    model_fn : str
+        Model regressors 1D file (e.g. *_desc-model_regressors.1D)
+    clean_fn : str
+        Output filename in the same format as bold_fn
+    polort : int, default: 2
+        Maximum Legendre polynomial degree
+    mask_fn : str, optional
+        Volumetric mask (NIfTI only); output is zero outside the mask
+
+    """
+    data, image = load_bold(bold_fn, mask_fn=mask_fn)
+    basis = cached_basis(model_fn, data.shape[0], polort=polort)
+    save_clean(regress_out(data, basis), clean_fn, image)
+
+
+# Function to regress one run's confounds out of all of its data targets
+def clean_run(targets, model_fn, polort=2):
+    """Apply one run's confound model to every data target for that run
+
+    The design is factorized once (see cached_basis) and its residual
+    projector is applied to each target, e.g. both hemispheres, the
+    volume and every ROI time series for the run. ROI (.1D) targets are
+    loaded into a single (TRs x ROIs) matrix and cleaned together.
+
+    Parameters
+    ----------
+    targets : list of tuple
+        (bold_fn, clean_fn, mask_fn) for each target; mask_fn may be
+        None (see clean_scan)
+    model_fn : str
+        Model regressors 1D file shared by all targets
+    polort : int, default: 2
+        Maximum Legendre polynomial degree
+
+    """
+    roi_targets = [target for target in targets
+                   if target[0].endswith('.1D')]
+    if roi_targets:
+        roi_data = load_1D_batch([bold_fn for bold_fn, _, _
+                                  in roi_targets])
+        basis = cached_basis(model_fn, roi_data.shape[0], polort=polort)
+        roi_clean = regress_out(roi_data, basis)
+        for (_, clean_fn, _), clean_data in zip(roi_targets, roi_clean.T):
+            write_1D(clean_data, clean_fn)
+
+    for bold_fn, clean_fn, mask_fn in targets:
+        if bold_fn.endswith('.1D'):
+            continue
+        clean_scan(bold_fn, model_fn, clean_fn, polort=polort,
+                   mask_fn=mask_fn)
+
+
+# Name guard for validating QR projection against least squares
+if __name__ == '__main__':
+
+    # Simulate data with drifts and confounds (plus a redundant column)
+    n_TRs, n_voxels = 300, 1000
+    prng = np.random.RandomState(0)
+    confounds = prng.randn(n_TRs, 12)
+    confounds[:, -1] = confounds[:, 0] + confounds[:, 1]
+    design = np.column_stack((legendre_trends(n_TRs), confounds))
+    data = (design @ prng.randn(design.shape[1], n_voxels) +
+            prng.randn(n_TRs, n_voxels) + 100)
+
+    # Residuals from least squares (as in 3dTproject)
+    betas = np.linalg.lstsq(design, data, rcond=None)[0]
+    difference = np.max(np.abs(regress_out(data, design_basis(design)) -
+                               (data - design @ betas)))
+    print(f"Maximum QR vs. least-squares difference = {difference:.2e}")
+    assert difference < 1e-8
@@ -1,6 +1,75 @@
 from os.path import basename
 
 
+# Parse BIDS entities (e.g. sub, task, run) from a filename
+def _parse_entities(bids_fn):
+    entities = {}
+    for part in basename(bids_fn).split('_'):
+        if '-' in part:
+            key, value = part.split('-', 1)
+            entities[key] = value.split('.')[0]
+    return entities
+
+
+class ExclusionIndex:
+    """Precompiled scan exclusion lookup built from scan_exclude.json
+
+    Exclusion entries (e.g. 'sub-001_task-pieman' or
+    'sub-001_task-pieman_run-1') are parsed once into (subject, task,
+    run) keys in a hashed set, so checking a filename is O(1) rather
+    than flattening and scanning the whole dictionary. An entry without
+    a run excludes all runs of that subject and task, matching the
+    substring semantics of the original exclude_scan. Entries that
+    don't parse into BIDS entities fall back to substring matching.
+
+    Parameters
+    ----------
+    scan_exclude : dict
+        Dictionary of scans to exclude (e.g. loaded from scan_exclude.json)
+
+    Examples
+    --------
+    >>> with open('scan_exclude.json') as f:
+            scan_exclude = ExclusionIndex(json.load(f))
+    >>> '/path/to/sub-001_task-pieman_run-1_bold.nii.gz' in scan_exclude
+    True
+    >>> bold_fns = scan_exclude.filter(bold_fns)
+
+    """
+
+    def __init__(self, scan_exclude):
+        self.keys = set()
+        self.patterns = []
+        self.n_entries = 0
+        for task in scan_exclude:
+            for subject in scan_exclude[task]:
+                for exclude_fn in scan_exclude[task][subject]:
+                    self.n_entries += 1
+                    entities = _parse_entities(exclude_fn)
+                    if ('sub' in entities and 'task' in entities and
+                        set(entities) <= {'sub', 'task', 'run'}):
+                        self.keys.add((entities['sub'], entities['task'],
+                                       entities.get('run')))
+                    else:
+                        self.patterns.append(exclude_fn)
+
+    def __len__(self):
+        return self.n_entries
+
+    def __contains__(self, bids_fn):
+        entities = _parse_entities(bids_fn)
+        subject, task = entities.get('sub'), entities.get('task')
+        if ((subject, task, None) in self.keys or
+            (subject, task, entities.get('run')) in self.keys):
+            return True
+        return any(pattern in basename(bids_fn)
+                   for pattern in self.patterns)
+
+    def filter(self, bids_fns):
+        """Return filenames that should not be excluded"""
+        return [bids_fn for bids_fn in bids_fns if bids_fn not in self]
+
+
 # Function to check if scan should be excluded
 def exclude_scan(bids_fn, scan_exclude):
     """Checks whether filename should be excluded given exclusion dictionary
@@ -9,8 +78,9 @@ def exclude_scan(bids_fn, scan_exclude):
     ----------
     bids_fn : str
         BIDS-formatted filename to be checked for exclusion
-    scan_exclude : dict
-        Dictionary of scans to exclude (e.g. loaded from scan_exclude.json)
+    scan_exclude : dict or ExclusionIndex
+        Dictionary of scans to exclude (e.g. loaded from scan_exclude.json);
+        pass a prebuilt ExclusionIndex when checking many files
 
     Returns
     -------
@@ -29,24 +99,10 @@ def exclude_scan(bids_fn, scan_exclude):
         Excluding scan /path/to/sub-001_task-pieman_run-1_bold.nii.gz
 
     """
-    
-    # Flatten input dictionary for simplicity
-    exclude_list = []
-    for task in scan_exclude:
-        if len(scan_exclude[task].keys()) > 0:
-            exclude_list.extend([r for s in 
-                                 list(scan_exclude[task].values())
-                                 for r in s])
-
-    # Check exclusion strings against BIDS input filename
-    for exclude_fn in exclude_list:
-        if exclude_fn in basename(bids_fn):
-            exclude = True
-            break
-        else:
-            exclude = False
+    if not isinstance(scan_exclude, ExclusionIndex):
+        scan_exclude = ExclusionIndex(scan_exclude)
 
-    return exclude
+    return bids_fn in scan_exclude
 
 
 # Name guard for when we want to compile exclusion lists via ISC
@@ -54,11 +110,10 @@ if __name__ == '__main__':
 
     from os.path import join
     import json
-    from natsort import natsorted
-    from glob import glob
     import numpy as np
-    from scipy.stats import pearsonr, zscore
+    from scipy.stats import pearsonr
     from brainiak.isc import isc
+    from load_timeseries import collect_scans, load_trimmed
 
     base_dir = '/jukebox/hasson/snastase/narratives'
     afni_dir = join(base_dir, 'derivatives', 'afni-nosmooth')
@@ -139,69 +194,38 @@ if __name__ == '__main__':
     initial_trim = 6
     threshold = 0.1
 
-    # Helper function to load in AFNI's 3dTproject 1D outputs
-    def load_1D(fn):
-        with open(fn) as f:
-            lines = [line.strip().split(' ') for line in f.readlines()
-                     if '#' not in line]
-        assert len(lines) == 1
-        return np.array(lines[0]).astype(float)
-
     with open(join(base_dir, 'code', 'task_meta.json')) as f:
         task_meta = json.load(f)
 
     with open(join(base_dir, 'code', 'event_meta.json')) as f:
         event_meta = json.load(f)
 
-    one_runs = []
-    multi_runs = {}
-    for subject in task_meta[task]:
+    # Grab event onsets and offsets for trimming
+    onset = event_meta[task][subtask]['onset']
+    offset = onset + event_meta[task][subtask]['duration']
 
-        # Grab event onsets and offsets for trimming
-        onset = event_meta[task][subtask]['onset']
-        offset = onset + event_meta[task][subtask]['duration']
+    # Collect all pieman ROI time series (without any exclusion)
+    subject_list, _, roi_fns = collect_scans(
+        afni_dir, task, hemi, task_meta,
+        f'roi-{roi}_desc-clean_timeseries.1D', space=space)
 
-        data_dir = join(afni_dir, subject, 'func')
+    one_runs = []
+    multi_runs = {}
+    for subject, roi_fn in zip(subject_list, roi_fns):
 
-        roi_fns = natsorted(glob(join(data_dir,
-                      (f'{subject}_task-{task}_*space-{space}_'
-                       f'hemi-{hemi}_roi-{roi}_desc-clean_'
-                       'timeseries.1D'))))
+        # Load trimmed, z-scored time series via shared loader
+        subj_data = load_trimmed(roi_fn, onset, offset,
+                                 initial_trim=initial_trim)
 
         # Grab subjects with only one run
-        if len(roi_fns) == 1:
-
-            roi_fn = roi_fns[0]
-
-            # Strip comments and load in data as numpy array
-            subj_data = load_1D(roi_fn)
-
-            # Trim data based on event onset and duration
-            subj_data = subj_data[onset:offset]
-            subj_data = subj_data[initial_trim:]
-
-            # Z-score input time series
-            subj_data = zscore(subj_data)
-
+        if subject_list.count(subject) == 1:
             one_runs.append(subj_data)
 
         # Grab subjects with multiple runs for later
-        elif len(roi_fns) > 1:
-
-            multi_runs[subject] = {}
-            for roi_fn in roi_fns:
-
-                # Strip comments and load in data as numpy array
-                subj_data = load_1D(roi_fn)
-
-                # Trim data based on event onset and duration
-                subj_data = subj_data[onset:offset]
-                subj_data = subj_data[initial_trim:]
-
-                # Z-score input time series
-                subj_data = zscore(subj_data)
-
-                multi_runs[subject][roi_fn] = subj_data        
+        else:
+            if subject not in multi_runs:
+                multi_runs[subject] = {}
+            multi_runs[subject][roi_fn] = subj_data
 
     # Get a clean average pieman template time series for comparison
     one_runs = np.column_stack(one_runs)
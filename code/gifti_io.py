@@ -1,20 +1,484 @@
+from os import (environ, getpid, listdir, makedirs, remove, replace,
+                stat, utime)
+from os.path import abspath, basename, dirname, getsize, join
+import base64
+import hashlib
+import zlib
+import xml.etree.ElementTree as ET
 import numpy as np
-import nibabel as nib
 
 
-# Function to read in GIfTI file as np.ndarray
-def read_gifti(gifti_fn):
-    gii = nib.load(gifti_fn)
-    data = np.vstack([da.data[np.newaxis, :]
-                      for da in gii.darrays]) 
+# GIfTI data types and endianness mapped onto NumPy dtypes
+gifti_dtypes = {'NIFTI_TYPE_UINT8': np.dtype('uint8'),
+                'NIFTI_TYPE_INT32': np.dtype('int32'),
+                'NIFTI_TYPE_FLOAT32': np.dtype('float32'),
+                'NIFTI_TYPE_FLOAT64': np.dtype('float64')}
+gifti_endians = {'LittleEndian': '<', 'BigEndian': '>'}
+gifti_encodings = ['ASCII', 'Base64Binary', 'GZipBase64Binary',
+                   'ExternalFileBinary']
+
+
+# Parse the DataArray headers (and encoded payloads) of a GIfTI file
+def _parse_darrays(gifti_fn):
+    darrays = []
+    for event, elem in ET.iterparse(gifti_fn, events=('end',)):
+        if elem.tag != 'DataArray':
+            continue
+        attrib = dict(elem.attrib)
+        n_dims = int(attrib.get('Dimensionality', 1))
+        dims = tuple(int(attrib[f'Dim{d}']) for d in range(n_dims))
+        dtype = gifti_dtypes[attrib['DataType']].newbyteorder(
+            gifti_endians[attrib.get('Endian', 'LittleEndian')])
+        order = ('F' if attrib.get('ArrayIndexingOrder') ==
+                 'ColumnMajorOrder' else 'C')
+        data = elem.find('Data')
+        darrays.append({'encoding': attrib['Encoding'],
+                        'dims': dims, 'dtype': dtype, 'order': order,
+                        'ext_fn': attrib.get('ExternalFileName', ''),
+                        'ext_offset': int(attrib.get(
+                            'ExternalFileOffset') or 0),
+                        'text': data.text if data is not None else None})
+
+        # Drop the parsed element so we only hold encoded payloads
+        elem.clear()
+
+    return darrays
+
+
+# Decode a single DataArray payload into a flat np.ndarray
+def _decode_darray(darray, gifti_fn):
+    encoding = darray['encoding']
+    if encoding == 'ExternalFileBinary':
+        data = np.memmap(join(dirname(gifti_fn), darray['ext_fn']),
+                         dtype=darray['dtype'], mode='c',
+                         offset=darray['ext_offset'],
+                         shape=darray['dims'], order=darray['order'])
+    elif encoding == 'ASCII':
+        data = np.array(darray['text'].split(), dtype=darray['dtype'])
+    elif encoding in ['Base64Binary', 'GZipBase64Binary']:
+        raw = base64.b64decode(darray['text'])
+        if encoding == 'GZipBase64Binary':
+            raw = zlib.decompress(raw)
+        data = np.frombuffer(raw, dtype=darray['dtype'])
+    else:
+        raise ValueError(f"Unrecognized GIfTI encoding {encoding}")
+    return data.reshape(darray['dims'], order=darray['order'])
+
+
+class GiftiArray:
+    """Lazy (rows x columns) view of the data arrays in a GIfTI file
+
+    The XML is parsed once to get the data array headers, but payloads
+    are only decoded when indexed. Each one-dimensional data array
+    (e.g. one TR of fMRIPrep surface output) is a row; a single
+    two-dimensional data array is split into rows directly. Indexing
+    with ``[rows, columns]`` decodes only the requested rows into one
+    preallocated buffer, and externally stored (raw binary) data are
+    memory-mapped so only the requested bytes are read from disk.
+
+    Parameters
+    ----------
+    gifti_fn : str
+        Filename of GIfTI file
+
+    Examples
+    --------
+    >>> bold = GiftiArray('sub-001_task-pieman_hemi-L.func.gii')
+    >>> bold.shape
+    (300, 40962)
+    >>> trimmed = bold[onset:offset, :]
+    >>> roi_data = bold[:, roi_mask == 1]
+
+    """
+
+    def __init__(self, gifti_fn):
+        self.gifti_fn = gifti_fn
+        self.darrays = _parse_darrays(gifti_fn)
+
+        if len(self.darrays) == 0:
+            raise ValueError(f"No data arrays found in {gifti_fn}")
+        dims = set(darray['dims'] for darray in self.darrays)
+        if len(dims) > 1:
+            raise ValueError(f"Mismatching data array shapes in {gifti_fn}")
+        dims = dims.pop()
+
+        # One row per 1D data array, or rows of a single 2D data array
+        if len(dims) == 1:
+            self.shape = (len(self.darrays), dims[0])
+        elif len(dims) == 2 and len(self.darrays) == 1:
+            self.shape = dims
+        else:
+            raise ValueError("Expected 1D data arrays or a single 2D "
+                             f"data array in {gifti_fn}")
+        self.dtype = self.darrays[0]['dtype'].newbyteorder('=')
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:, :]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+    # Memory-map the whole array if stored contiguously in one external file
+    def _memmap(self):
+        if any(darray['encoding'] != 'ExternalFileBinary'
+               for darray in self.darrays):
+            return None
+        first = self.darrays[0]
+        if len(self.darrays) == 1:
+            data = _decode_darray(first, self.gifti_fn)
+            return data.reshape(self.shape)
+        row_bytes = self.shape[1] * first['dtype'].itemsize
+        for i, darray in enumerate(self.darrays):
+            if (darray['ext_fn'] != first['ext_fn'] or
+                darray['ext_offset'] != first['ext_offset'] + i * row_bytes):
+                return None
+        return np.memmap(join(dirname(self.gifti_fn), first['ext_fn']),
+                         dtype=first['dtype'], mode='c',
+                         offset=first['ext_offset'], shape=self.shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        if len(key) != 2:
+            raise IndexError("GiftiArray supports (rows, columns) indexing")
+        row_key, col_key = key
+
+        # Contiguous external data can be sliced directly as a view
+        memmap = self._memmap()
+        if memmap is not None:
+            return memmap[row_key, col_key]
+
+        rows = np.arange(self.shape[0])[row_key]
+        squeeze = np.ndim(rows) == 0
+        rows = np.atleast_1d(rows)
+
+        # Integer column keys are indexed as one column, then dropped
+        columns = np.arange(self.shape[1])[col_key]
+        squeeze_columns = np.ndim(columns) == 0
+        if squeeze_columns:
+            col_key = np.atleast_1d(columns)
+        n_columns = len(np.atleast_1d(columns))
+
+        # Single 2D data array must be decoded in full, then indexed
+        if len(self.darrays) == 1 and self.shape[0] > 1:
+            full = _decode_darray(self.darrays[0], self.gifti_fn)
+            data = np.empty((len(rows), n_columns), dtype=self.dtype)
+            data[:] = full[rows][:, col_key]
+
+        # Otherwise decode only requested rows into a preallocated buffer
+        else:
+            data = np.empty((len(rows), n_columns), dtype=self.dtype)
+            for i, row in enumerate(rows):
+                data[i] = _decode_darray(self.darrays[row],
+                                         self.gifti_fn)[col_key]
+
+        if squeeze_columns:
+            data = data[:, 0]
+        return data[0] if squeeze else data
+
+
+# Optional sidecar cache of decoded data (off unless a directory is set)
+cache = {'directory': environ.get('GIFTI_CACHE_DIR'),
+         'budget': float(environ.get('GIFTI_CACHE_BUDGET',
+                                     100 * 1024 ** 3))}
+
+
+# Function to turn on (or off) the decoded GIfTI sidecar cache
+def set_cache(directory, budget=100 * 1024 ** 3):
+    """Cache decoded GIfTI data as memory-mappable .npy sidecars
+
+    Cached files are keyed by source path, modification time and size,
+    so regenerating a GIfTI file invalidates its sidecar. When the
+    cache exceeds the disk budget, the least recently used sidecars
+    are evicted. The cache can also be enabled via the GIFTI_CACHE_DIR
+    (and GIFTI_CACHE_BUDGET, in bytes) environment variables.
+
+    Parameters
+    ----------
+    directory : str or None
+        Cache directory; None disables caching
+    budget : int, default: 100 GB
+        Maximum total size of cached sidecars in bytes
+
+    """
+    cache['directory'] = directory
+    cache['budget'] = budget
+
+
+# Get sidecar cache filename for a GIfTI file
+def _cache_fn(gifti_fn):
+    gifti_stat = stat(gifti_fn)
+    key = (f'{abspath(gifti_fn)}:{gifti_stat.st_mtime_ns}:'
+           f'{gifti_stat.st_size}')
+    return join(cache['directory'],
+                hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+
+# Evict least recently used sidecars until cache is within budget
+def _evict_cache(keep_fn):
+    cache_fns = [join(cache['directory'], fn)
+                 for fn in listdir(cache['directory'])
+                 if fn.endswith('.npy') and '.tmp' not in fn]
+
+    # Other processes may evict sidecars after listing, so skip them
+    cache_stats = []
+    for fn in cache_fns:
+        try:
+            cache_stats.append((stat(fn).st_mtime, getsize(fn), fn))
+        except FileNotFoundError:
+            continue
+    cache_stats.sort()
+
+    total = sum(size for _, size, _ in cache_stats)
+    for _, size, fn in cache_stats:
+        if total <= cache['budget']:
+            break
+        if fn == keep_fn:
+            continue
+        try:
+            remove(fn)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+# Load GIfTI data via the sidecar cache, decoding on first read
+def _read_cached(gifti_fn):
+    cache_fn = _cache_fn(gifti_fn)
+
+    # Touch sidecar to mark it as recently used (it may be evicted by
+    # another process at any time, in which case it is decoded again)
+    try:
+        utime(cache_fn)
+        return np.load(cache_fn, mmap_mode='r')
+    except FileNotFoundError:
+        pass
+
+    data = GiftiArray(gifti_fn)[:, :]
+    makedirs(cache['directory'], exist_ok=True)
+
+    # Write to temporary file first so readers never see partial data
+    tmp_fn = cache_fn.replace('.npy', f'.{getpid()}.tmp.npy')
+    np.save(tmp_fn, np.ascontiguousarray(data))
+    replace(tmp_fn, cache_fn)
+    try:
+        data = np.load(cache_fn, mmap_mode='r')
+    except FileNotFoundError:
+        pass
+    _evict_cache(cache_fn)
     return data
 
 
+# Function to read in GIfTI file as np.ndarray
+def read_gifti(gifti_fn, lazy=False):
+    """Read GIfTI data arrays into a (rows x columns) array
+
+    Parameters
+    ----------
+    gifti_fn : str
+        Filename of GIfTI file
+    lazy : bool, default: False
+        Return a GiftiArray that decodes rows only when indexed (or a
+        read-only memory-map if the sidecar cache is enabled)
+
+    Returns
+    -------
+    np.ndarray or GiftiArray
+        Data arrays stacked as rows (e.g. TRs x vertices)
+
+    """
+    if cache['directory']:
+        data = _read_cached(gifti_fn)
+        if lazy:
+            return data
+        return np.array(data)
+
+    data = GiftiArray(gifti_fn)
+    if lazy:
+        return data
+    return data[:, :]
+
+
+# Cache of parsed template headers keyed by filename
+header_cache = {}
+
+
+# Function to read GIfTI header metadata without decoding any data
+def read_gifti_header(template_fn):
+    """Read header metadata and label table from a GIfTI template
+
+    Parsing stops before the data of the first DataArray, so only the
+    header bytes of (potentially very large) template files are read.
+    Headers are cached per template filename and modification time.
+
+    Parameters
+    ----------
+    template_fn : str
+        Filename of template GIfTI file
+
+    Returns
+    -------
+    dict
+        Lightweight header with 'version', 'meta' and 'labeltable'
+        (the latter two as serialized XML strings or None), plus the
+        'intent' and 'darray_meta' of the first DataArray (or None)
+
+    """
+    key = (abspath(template_fn), stat(template_fn).st_mtime_ns)
+    if key in header_cache:
+        return header_cache[key]
+
+    header = {'version': '1.0', 'meta': None, 'labeltable': None,
+              'intent': None, 'darray_meta': None}
+    depth = 0
+    for event, elem in ET.iterparse(template_fn, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if elem.tag == 'GIFTI':
+                header['version'] = elem.attrib.get('Version', '1.0')
+            elif elem.tag == 'DataArray':
+                header['intent'] = elem.attrib.get('Intent')
+            elif elem.tag == 'Data':
+                break
+        else:
+            depth -= 1
+            if depth == 1 and elem.tag == 'MetaData':
+                header['meta'] = ET.tostring(elem, encoding='unicode')
+            elif depth == 1 and elem.tag == 'LabelTable':
+                header['labeltable'] = ET.tostring(elem, encoding='unicode')
+            elif depth == 2 and elem.tag == 'MetaData':
+                header['darray_meta'] = ET.tostring(elem, encoding='unicode')
+                break
+
+    header_cache[key] = header
+    return header
+
+
+# Encode np.ndarray as a DataArray XML string
+def _encode_darray(data, output_fn, encoding, intent='NIFTI_INTENT_NONE',
+                   meta=None):
+    if data.dtype == bool:
+        data = data.astype(np.uint8)
+    elif data.dtype.kind in 'iu' and data.dtype != np.uint8:
+        data = data.astype(np.int32)
+    elif data.dtype not in [np.float32, np.float64, np.int32, np.uint8]:
+        data = data.astype(np.float32)
+    data = np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('<'))
+    datatype = [label for label, dtype in gifti_dtypes.items()
+                if dtype == data.dtype][0]
+
+    ext_fn, ext_offset = '', ''
+    if encoding == 'ASCII':
+        fmt = '%.9g' if data.dtype.kind == 'f' else '%d'
+        text = ' '.join(fmt % value for value in data.ravel())
+    elif encoding in ['Base64Binary', 'GZipBase64Binary']:
+        raw = data.tobytes()
+        if encoding == 'GZipBase64Binary':
+            raw = zlib.compress(raw)
+        text = base64.b64encode(raw).decode()
+    elif encoding == 'ExternalFileBinary':
+        ext_fn, ext_offset, text = basename(output_fn) + '.dat', '0', ''
+        data.tofile(output_fn + '.dat')
+    else:
+        raise ValueError(f"Unrecognized GIfTI encoding {encoding}; "
+                         f"expected one of {gifti_encodings}")
+
+    dims = ' '.join(f'Dim{d}="{n}"' for d, n in enumerate(data.shape))
+    return (f'<DataArray Intent="{intent}" '
+            f'DataType="{datatype}" ArrayIndexingOrder="RowMajorOrder" '
+            f'Dimensionality="{data.ndim}" {dims} '
+            f'Encoding="{encoding}" Endian="LittleEndian" '
+            f'ExternalFileName="{ext_fn}" '
+            f'ExternalFileOffset="{ext_offset}">\n'
+            f'{meta or "<MetaData/>"}\n<Data>{text}</Data>\n'
+            '</DataArray>\n')
+
+
 # Function to write np.ndarray to GIfTI file
-def write_gifti(data, output_fn, template_fn):
-    gii = nib.load(template_fn)
-    for i in np.arange(gii.numDA):
-        gii.remove_gifti_data_array(0)
-    gda = nib.gifti.GiftiDataArray(data)
-    gii.add_gifti_data_array(gda)
-    nib.gifti.giftiio.write(gii, output_fn)
+def write_gifti(data, output_fn, template_fn=None, header=None,
+                encoding='GZipBase64Binary', split_rows=False):
+    """Write np.ndarray to GIfTI file using template header metadata
+
+    Only the header of the template is parsed (and cached), so writing
+    e.g. a single ISC map does not require loading the template data.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Data to be written as a single data array (e.g. vertices)
+    output_fn : str
+        Output GIfTI filename
+    template_fn : str, optional
+        GIfTI file from which to copy header metadata and label table
+    header : dict, optional
+        Header returned by read_gifti_header (instead of template_fn)
+    encoding : str, default: 'GZipBase64Binary'
+        One of 'ASCII', 'Base64Binary', 'GZipBase64Binary', or
+        'ExternalFileBinary' (raw binary in an adjacent .dat file)
+    split_rows : bool, default: False
+        Write each row of 2D data as its own data array (e.g. one per
+        TR, as in .func.gii time series), copying the intent (default
+        NIFTI_INTENT_TIME_SERIES) and metadata of the template's first
+        data array
+
+    """
+    if header is None:
+        if template_fn is None:
+            header = {'version': '1.0', 'meta': None, 'labeltable': None,
+                      'intent': None, 'darray_meta': None}
+        else:
+            header = read_gifti_header(template_fn)
+
+    data = np.asarray(data)
+    if split_rows:
+        if encoding == 'ExternalFileBinary':
+            raise ValueError("ExternalFileBinary is only supported for "
+                             "a single data array")
+        intent = header['intent'] or 'NIFTI_INTENT_TIME_SERIES'
+        darrays = [_encode_darray(row, output_fn, encoding, intent=intent,
+                                  meta=header['darray_meta'])
+                   for row in data]
+    else:
+        darrays = [_encode_darray(data, output_fn, encoding)]
+    with open(output_fn, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<!DOCTYPE GIFTI SYSTEM "http://www.nitrc.org/frs/'
+                'download.php/115/gifti.dtd">\n'
+                f'<GIFTI Version="{header["version"]}" '
+                f'NumberOfDataArrays="{len(darrays)}">\n')
+        f.write((header['meta'] or '<MetaData/>') + '\n')
+        f.write((header['labeltable'] or '<LabelTable/>') + '\n')
+        for darray in darrays:
+            f.write(darray)
+        f.write('</GIFTI>\n')
+
+
+# Function to write several np.ndarrays to GIfTI files in one call
+def batch_write_gifti(data, output_fns, template_fn=None, header=None,
+                      encoding='GZipBase64Binary'):
+    """Write each row of data to a GIfTI file sharing one template header
+
+    Parameters
+    ----------
+    data : np.ndarray or list
+        Maps to write (e.g. scans x vertices ISC maps)
+    output_fns : list of str
+        Output GIfTI filenames (one per map)
+    template_fn : str, optional
+        GIfTI file from which to copy header metadata and label table
+    header : dict, optional
+        Header returned by read_gifti_header (instead of template_fn)
+    encoding : str, default: 'GZipBase64Binary'
+        GIfTI encoding passed to write_gifti
+
+    """
+    if len(data) != len(output_fns):
+        raise ValueError("Number of maps and output filenames must match")
+    if header is None and template_fn is not None:
+        header = read_gifti_header(template_fn)
+    for d, output_fn in zip(data, output_fns):
+        write_gifti(d, output_fn, header=header, encoding=encoding)
@@ -0,0 +1,1034 @@
+from os import getpid, replace, stat
+from os.path import exists
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+import json
+import warnings
+import numpy as np
+from scipy.fft import irfft, next_fast_len, rfft
+from scipy.stats import zscore
+
+
+# Check time series input and reshape to (TRs x voxels x subjects)
+def _check_data(data):
+    data = np.asarray(data)
+    if data.ndim == 2:
+        data = data[:, np.newaxis, :]
+    elif data.ndim != 3:
+        raise ValueError("Expected (TRs x voxels x subjects) or "
+                         "(TRs x subjects) input data")
+    if data.shape[2] < 2:
+        raise ValueError("Leave-one-out ISC requires at least 2 subjects")
+    return data
+
+
+# Function for leave-one-out ISC using the sum of all subjects
+def isc(data, zscored=False, dtype=None):
+    """Leave-one-out intersubject correlation (ISC) via the sum trick
+
+    Rather than recomputing each leave-one-out mean from scratch, the
+    sum across all subjects is computed once. For z-scored data, the
+    correlation between subject s and the mean of the others,
+    (total - s) / (n - 1), reduces to dot products with the total:
+
+        r_s = (x_s . total - T) / sqrt(T * (total . total
+                                             - 2 * x_s . total + T))
+
+    so all ISCs are computed with one batched product over subjects.
+    Subjects with NaNs at a voxel (e.g. constant time series) are left
+    out of the sum there, so the remaining subjects' ISCs are computed
+    from the mean of the other valid subjects and only the invalid
+    subjects get NaN (as in brainiak.isc.isc with tolerate_nans=True).
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Time series data (TRs x voxels x subjects) or (TRs x subjects)
+    zscored : bool, default: False
+        Whether input time series are already z-scored across TRs
+    dtype : np.dtype, optional
+        Compute in this precision (e.g. np.float32); defaults to the
+        precision of the input data
+
+    Returns
+    -------
+    np.ndarray
+        Leave-one-out ISC values (subjects x voxels)
+
+    """
+    data = _check_data(data)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    if not zscored:
+        data = zscore(data, axis=0)
+    data, valid = _valid_subjects(data)
+    n_TRs = data.shape[0]
+
+    # Sum across all (valid) subjects computed once
+    total = np.sum(data, axis=2)
+
+    # Batched dot products of each subject with the total
+    subject_total = np.einsum('tvs,tv->sv', data, total)
+    total_total = np.einsum('tv,tv->v', total, total)
+
+    iscs = _loo_correlation(subject_total, total_total, n_TRs)
+    iscs[~valid.T] = np.nan
+    return iscs
+
+
+# Zero out time series with NaNs (e.g. constant after z-scoring) so they
+# drop out of sums across subjects, returning (voxels x subjects) validity
+def _valid_subjects(data):
+    valid = ~np.any(np.isnan(data), axis=0)
+    if not np.all(valid):
+        data = np.where(valid, data, 0)
+    return data, valid
+
+
+# Correlation with leave-one-out mean from dot products with the total
+def _loo_correlation(subject_total, total_total, n_TRs):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((subject_total - n_TRs) /
+                np.sqrt(n_TRs * (total_total - 2 * subject_total + n_TRs)))
+
+
+# Cross-correlate each subject with the sum of all other subjects
+def _loo_cross_correlation(data, n_fft):
+    spectra = rfft(data, n=n_fft, axis=0)
+    others = np.sum(spectra, axis=2, keepdims=True) - spectra
+    return irfft(np.conj(spectra) * others, n=n_fft, axis=0)
+
+
+# Cumulative sum across TRs with a leading zero (for range sums)
+def _cumulative_sum(data):
+    return np.concatenate((np.zeros((1,) + data.shape[1:], dtype=data.dtype),
+                           np.cumsum(data, axis=0)))
+
+
+# Function for leave-one-out ISC at varying lags via FFT
+def lagged_isc(data, lags=20, circular=True, zscored=False, dtype=None):
+    """Leave-one-out ISC at every lag from one FFT cross-correlation
+
+    Each subject is cross-correlated with the sum of the other subjects
+    (proportional to their mean) for all lags at once in the frequency
+    domain, rather than shifting and correlating one lag at a time.
+    With circular=True, lag L correlates the subject rolled forward by
+    L TRs (i.e. np.roll(x, L)) with the mean of the others. Otherwise,
+    the non-overlapping TRs are trimmed: lag L > 0 pairs x[L:] with the
+    mean[:-L] (and vice versa for L < 0), and each lag is normalized
+    using only the overlapping TRs (from cumulative sums) so results
+    match Pearson correlations of the trimmed time series. As in isc,
+    subjects with NaNs at a voxel are left out of the others' mean and
+    only their own lagged ISCs are NaN.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Time series data (TRs x voxels x subjects) or (TRs x subjects)
+    lags : int or array, default: 20
+        Maximum lag (giving -lags to +lags) or array of lags in TRs
+    circular : bool, default: True
+        Wrap shifted TRs around rather than trimming them
+    zscored : bool, default: False
+        Whether input time series are already z-scored across TRs
+    dtype : np.dtype, optional
+        Compute in this precision (e.g. np.float32); defaults to the
+        precision of the input data
+
+    Returns
+    -------
+    lagged_iscs : np.ndarray
+        Leave-one-out ISC at each lag (lags x voxels x subjects)
+    peak_lags : np.ndarray
+        Lag with the maximum ISC (voxels x subjects); NaN where ISC is
+        NaN at every lag
+
+    """
+    data = _check_data(data)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    if not zscored:
+        data = zscore(data, axis=0)
+    data, valid = _valid_subjects(data)
+    n_TRs = data.shape[0]
+
+    # If lag is integer, get positive and negative range around zero
+    if isinstance(lags, (int, np.integer)):
+        lags = np.arange(-lags, lags + 1)
+    lags = np.asarray(lags)
+    if np.any(np.abs(lags) >= n_TRs):
+        raise ValueError("Lags must be shorter than the time series")
+
+    # Cross-products sum_t x[t] * others[t + k] for every shift k
+    if circular:
+        cross = _loo_cross_correlation(data, n_TRs)
+        products = cross[lags % n_TRs]
+
+        # Sums of squares are unchanged by circular shifts
+        others = np.sum(data, axis=2, keepdims=True) - data
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lagged_iscs = products / np.sqrt(
+                np.sum(data ** 2, axis=0) * np.sum(others ** 2, axis=0))
+
+    else:
+        n_fft = next_fast_len(2 * n_TRs - 1)
+        cross = _loo_cross_correlation(data, n_fft)
+        shifts = -lags
+        products = cross[shifts % n_fft]
+
+        # Cumulative sums for means and variances of overlapping TRs
+        others = np.sum(data, axis=2, keepdims=True) - data
+        x_sum, x_squares = _cumulative_sum(data), _cumulative_sum(data ** 2)
+        m_sum = _cumulative_sum(others)
+        m_squares = _cumulative_sum(others ** 2)
+
+        x_start, x_stop = np.maximum(0, -shifts), n_TRs - np.maximum(0, shifts)
+        m_start, m_stop = np.maximum(0, shifts), n_TRs - np.maximum(0, -shifts)
+        n_overlap = (n_TRs - np.abs(shifts)).astype(data.dtype)
+        n_overlap = n_overlap[:, np.newaxis, np.newaxis]
+
+        sx = x_sum[x_stop] - x_sum[x_start]
+        sxx = x_squares[x_stop] - x_squares[x_start]
+        sm = m_sum[m_stop] - m_sum[m_start]
+        smm = m_squares[m_stop] - m_squares[m_start]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            lagged_iscs = ((products - sx * sm / n_overlap) /
+                           np.sqrt((sxx - sx ** 2 / n_overlap) *
+                                   (smm - sm ** 2 / n_overlap)))
+
+    # Subjects with NaNs at a voxel are left out of the others' sums
+    lagged_iscs[:, ~valid] = np.nan
+
+    # Compute lag for maximum ISC per voxel and subject (NaN where ISC
+    # is NaN at every lag, e.g. medial wall vertices)
+    peak_lags = lags[np.argmax(np.nan_to_num(lagged_iscs, nan=-np.inf),
+                               axis=0)].astype(float)
+    peak_lags[np.all(np.isnan(lagged_iscs), axis=0)] = np.nan
+
+    return lagged_iscs, peak_lags
+
+
+# Function for leave-one-out ISC streaming over one scan at a time
+def streaming_isc(scans, load, zscored=False, dtype=None):
+    """Leave-one-out ISC without holding all subjects in memory
+
+    Two passes are made over the scans: the first accumulates the sum
+    of z-scored time series across subjects, and the second reloads
+    each scan and correlates it with its leave-one-out mean (derived
+    from the sum as in isc). Peak memory is two (TRs x voxels) buffers
+    regardless of the number of subjects.
+
+    Parameters
+    ----------
+    scans : list
+        Scan identifiers (e.g. filenames) passed to load
+    load : callable
+        Function returning (TRs x voxels) data for a scan
+    zscored : bool, default: False
+        Whether loaded time series are already z-scored across TRs
+    dtype : np.dtype, optional
+        Compute in this precision (e.g. np.float32); defaults to the
+        precision of the loaded data
+
+    Returns
+    -------
+    np.ndarray
+        Leave-one-out ISC values (subjects x voxels)
+
+    """
+    if len(scans) < 2:
+        raise ValueError("Leave-one-out ISC requires at least 2 subjects")
+
+    # Load and (optionally) z-score a single scan
+    def load_scan(scan):
+        subj_data = np.asarray(load(scan), dtype=dtype)
+        if subj_data.ndim == 1:
+            subj_data = subj_data[:, np.newaxis]
+        if not zscored:
+            subj_data = zscore(subj_data, axis=0)
+        return _valid_subjects(subj_data)
+
+    # First pass: accumulate sum across (valid) subjects
+    total = None
+    for scan in scans:
+        subj_data, _ = load_scan(scan)
+        if total is None:
+            total = np.zeros(subj_data.shape, dtype=subj_data.dtype)
+        total += subj_data
+    n_TRs = total.shape[0]
+    total_total = np.einsum('tv,tv->v', total, total)
+
+    # Second pass: correlate each scan with its leave-one-out mean
+    iscs = np.empty((len(scans), total.shape[1]), dtype=total.dtype)
+    for s, scan in enumerate(scans):
+        subj_data, valid = load_scan(scan)
+        subject_total = np.einsum('tv,tv->v', subj_data, total)
+        iscs[s] = _loo_correlation(subject_total, total_total, n_TRs)
+        iscs[s, ~valid] = np.nan
+
+    return iscs
+
+
+# Convert human-readable memory size (e.g. '4GB') to bytes
+def parse_memory(size):
+    if isinstance(size, (int, float)):
+        return int(size)
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip('B')
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size))
+
+
+# Function to get number of vertices per block given a memory budget
+def vertex_block_size(max_mem, n_TRs, n_subjects, itemsize=8,
+                      streaming=False):
+    """Number of vertices per block that fits within a memory budget
+
+    Stacked ISC holds the (TRs x vertices x subjects) block plus a
+    z-scored copy and the sum across subjects; streaming ISC holds
+    one scan, its z-scored copy and the sum.
+
+    Parameters
+    ----------
+    max_mem : str or int
+        Memory budget (e.g. '4GB') or number of bytes
+    n_TRs : int
+        Number of TRs per scan
+    n_subjects : int
+        Number of scans
+    itemsize : int, default: 8
+        Bytes per value (e.g. 8 for float64)
+    streaming : bool, default: False
+        Whether blocks are computed with streaming_isc
+
+    Returns
+    -------
+    int
+        Number of vertices per block (at least 1)
+
+    """
+    n_buffers = 3 if streaming else 2 * n_subjects + 1
+    bytes_per_vertex = n_TRs * n_buffers * itemsize
+    return max(1, parse_memory(max_mem) // bytes_per_vertex)
+
+
+# Function for leave-one-out ISC computed in blocks of vertices
+def chunked_isc(scans, load, n_vertices, n_TRs, max_mem, zscored=False,
+                streaming=False, dtype=np.float64):
+    """Leave-one-out ISC over vertex blocks sized from a memory budget
+
+    Only the vertex columns of the current block are loaded from each
+    scan, and per-block ISCs are stitched back into full maps.
+
+    Parameters
+    ----------
+    scans : list
+        Scan identifiers (e.g. filenames) passed to load
+    load : callable
+        Function returning (TRs x vertices) data for a scan, accepting
+        a ``vertices`` keyword (slice of vertex columns)
+    n_vertices : int
+        Total number of vertices
+    n_TRs : int
+        Number of TRs per scan (used to size blocks)
+    max_mem : str or int
+        Memory budget (e.g. '4GB') or number of bytes
+    zscored : bool, default: False
+        Whether loaded time series are already z-scored across TRs
+    streaming : bool, default: False
+        Compute each block with streaming_isc rather than stacking
+    dtype : np.dtype, default: np.float64
+        Precision of computation (also used to size blocks)
+
+    Returns
+    -------
+    np.ndarray
+        Leave-one-out ISC values (subjects x vertices)
+
+    """
+    block_size = vertex_block_size(max_mem, n_TRs, len(scans),
+                                   itemsize=np.dtype(dtype).itemsize,
+                                   streaming=streaming)
+    print(f"Computing ISC in blocks of {block_size} vertices")
+
+    iscs = None
+    for start in np.arange(0, n_vertices, block_size):
+        block = slice(start, min(start + block_size, n_vertices))
+        load_block = partial(load, vertices=block)
+
+        if streaming:
+            block_iscs = streaming_isc(scans, load_block, zscored=zscored,
+                                       dtype=dtype)
+        else:
+            block_iscs = isc(np.dstack([load_block(scan) for scan in scans]),
+                             zscored=zscored, dtype=dtype)
+
+        if iscs is None:
+            iscs = np.empty((len(scans), n_vertices), dtype=block_iscs.dtype)
+        iscs[:, block] = block_iscs
+
+    return iscs
+
+
+# Sums over sliding windows from a cumulative sum with a leading zero
+def _window_sums(cumulative, width, step):
+    return cumulative[width::step] - cumulative[:-width:step]
+
+
+# Function for sliding-window (dynamic) leave-one-out ISC
+def dynamic_isc(data, width, step=1, zscored=False, dtype=None):
+    """Leave-one-out ISC in sliding windows via cumulative sums
+
+    Rather than re-correlating every window, cumulative sums over TRs
+    of each subject's time series, its square and its product with the
+    sum across subjects (plus the sum and its square) are computed once,
+    so the sums for any window are a difference of two cumulative sums
+    and each window update is O(1) per voxel. Correlations with the
+    leave-one-out mean use window-specific means and variances (i.e.
+    Pearson correlation within each window). Subjects are processed one
+    at a time, and cumulative sums are kept in double precision to
+    avoid cancellation in long scans. As in isc, subjects with NaNs at
+    a voxel are left out of the total and only their own ISCs are NaN.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Time series data (TRs x voxels x subjects) or (TRs x subjects)
+    width : int
+        Window width in TRs
+    step : int, default: 1
+        Number of TRs between window onsets
+    zscored : bool, default: False
+        Whether input time series are already z-scored across TRs
+    dtype : np.dtype, optional
+        Precision of returned ISCs; defaults to the precision of the
+        input data
+
+    Returns
+    -------
+    np.ndarray
+        Windowed leave-one-out ISC values (subjects x windows x voxels)
+        for windows starting at TRs 0, step, 2 * step, ...
+
+    """
+    data = _check_data(data)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    if not zscored:
+        data = zscore(data, axis=0)
+    data, valid = _valid_subjects(data)
+    n_TRs, n_voxels, n_subjects = data.shape
+    if not 1 < width <= n_TRs:
+        raise ValueError("Window width must be between 2 and the "
+                         "number of TRs")
+    n_windows = (n_TRs - width) // step + 1
+
+    # Windowed sums of the total across subjects (and its square)
+    total = np.sum(data, axis=2, dtype=np.float64)
+    total_sum = _window_sums(_cumulative_sum(total), width, step)
+    total_squares = _window_sums(_cumulative_sum(total ** 2), width, step)
+
+    iscs = np.empty((n_subjects, n_windows, n_voxels), dtype=data.dtype)
+    for s in np.arange(n_subjects):
+        subj_data = data[..., s].astype(np.float64)
+        x_sum = _window_sums(_cumulative_sum(subj_data), width, step)
+        x_squares = _window_sums(_cumulative_sum(subj_data ** 2),
+                                 width, step)
+        x_total = _window_sums(_cumulative_sum(subj_data * total),
+                               width, step)
+
+        # Leave-one-out sums (total - x) from the windowed sums
+        m_sum = total_sum - x_sum
+        m_squares = total_squares - 2 * x_total + x_squares
+        x_m = x_total - x_squares
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            iscs[s] = ((x_m - x_sum * m_sum / width) /
+                       np.sqrt((x_squares - x_sum ** 2 / width) *
+                               (m_squares - m_sum ** 2 / width)))
+        iscs[s][:, ~valid[:, s]] = np.nan
+
+    return iscs
+
+
+# Function for peak lagged ISC computed in blocks of vertices
+def chunked_lagged_isc(scans, load, n_vertices, n_TRs, max_mem, lags=20,
+                       circular=True, zscored=False, dtype=np.float64):
+    """Peak lag and peak leave-one-out ISC over vertex blocks
+
+    Lagged ISCs are computed with lagged_isc for one block of vertices
+    at a time (only those vertex columns are loaded from each scan) and
+    reduced to the peak lag and peak ISC per vertex, so the full (lags
+    x vertices x subjects) array is never held for the whole brain.
+
+    Parameters
+    ----------
+    scans : list
+        Scan identifiers (e.g. filenames) passed to load
+    load : callable
+        Function returning (TRs x vertices) data for a scan, accepting
+        a ``vertices`` keyword (slice of vertex columns)
+    n_vertices : int
+        Total number of vertices
+    n_TRs : int
+        Number of TRs per scan (used to size blocks)
+    max_mem : str or int
+        Memory budget (e.g. '4GB') or number of bytes
+    lags : int or array, default: 20
+        Maximum lag (giving -lags to +lags) or array of lags in TRs
+    circular : bool, default: True
+        Wrap shifted TRs around rather than trimming them
+    zscored : bool, default: False
+        Whether loaded time series are already z-scored across TRs
+    dtype : np.dtype, default: np.float64
+        Precision of computation (also used to size blocks)
+
+    Returns
+    -------
+    peak_lags : np.ndarray
+        Lag with the maximum ISC (subjects x vertices); NaN where ISC is
+        NaN at every lag
+    peak_iscs : np.ndarray
+        Maximum ISC across lags (subjects x vertices)
+
+    """
+    if isinstance(lags, (int, np.integer)):
+        lags = np.arange(-lags, lags + 1)
+    n_fft = n_TRs if circular else next_fast_len(2 * n_TRs - 1)
+
+    # Per vertex: stacked data, z-scored copy, leave-one-out sums, FFT
+    # spectra and cross-correlations (plus cumulative sums if trimming)
+    n_buffers = (3 + 4) * n_TRs + 3 * n_fft + 2 * len(lags)
+    if not circular:
+        n_buffers += 4 * (n_TRs + 1)
+    bytes_per_vertex = n_buffers * len(scans) * np.dtype(dtype).itemsize
+    block_size = max(1, parse_memory(max_mem) // bytes_per_vertex)
+    print(f"Computing lagged ISC in blocks of {block_size} vertices")
+
+    peak_lags = np.empty((len(scans), n_vertices))
+    peak_iscs = np.empty((len(scans), n_vertices), dtype=dtype)
+    for start in np.arange(0, n_vertices, block_size):
+        block = slice(start, min(start + block_size, n_vertices))
+        data = np.dstack([load(scan, vertices=block) for scan in scans])
+        lagged_iscs, block_lags = lagged_isc(data, lags=lags,
+                                             circular=circular,
+                                             zscored=zscored, dtype=dtype)
+        peak_lags[:, block] = block_lags.T
+        peak_iscs[:, block] = np.fmax.reduce(lagged_iscs, axis=0).T
+
+    return peak_lags, peak_iscs
+
+
+# Weights for dot products between one-sided (rfft) spectra
+def _spectral_weights(n_TRs, n_freqs, dtype):
+    weights = np.full(n_freqs, 2, dtype=dtype)
+    weights[0] = 1
+    if n_TRs % 2 == 0:
+        weights[-1] = 1
+    return weights / n_TRs
+
+
+# Leave-one-out ISC computed directly from (freqs x voxels x subjects)
+# spectra of z-scored data (dot products via Parseval's theorem)
+def _spectral_isc(spectra, weights, n_TRs):
+    total = np.sum(spectra, axis=2)
+    weighted = weights[:, np.newaxis] * total
+
+    # Real part of conj(x) * y as separate real and imaginary products
+    subject_total = (np.einsum('fvs,fv->sv', spectra.real, weighted.real) +
+                     np.einsum('fvs,fv->sv', spectra.imag, weighted.imag))
+    total_total = (np.einsum('fv,fv->v', total.real, weighted.real) +
+                   np.einsum('fv,fv->v', total.imag, weighted.imag))
+    return _loo_correlation(subject_total, total_total, n_TRs)
+
+
+# Fisher z-transformed mean of ISCs across subjects
+def _fisher_mean(iscs):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.tanh(np.nanmean(np.arctanh(iscs), axis=0))
+
+
+# Random phase rotations (freqs x subjects) for one surrogate
+def _surrogate_phases(prng, method, n_TRs, n_freqs, n_subjects):
+    if method == 'phase':
+        phases = prng.uniform(0, 2 * np.pi, (n_freqs, n_subjects))
+        phases[0] = 0
+        if n_TRs % 2 == 0:
+            phases[-1] = 0
+    elif method == 'shift':
+        shifts = prng.integers(1, n_TRs, n_subjects)
+        phases = (-2 * np.pi * np.arange(n_freqs)[:, np.newaxis] *
+                  shifts[np.newaxis, :] / n_TRs)
+    else:
+        raise ValueError("Surrogate method must be 'phase' or 'shift'")
+    return np.exp(1j * phases)
+
+
+# Spectra and observed statistics shared by surrogate batches (set
+# before forking so worker processes don't need them pickled)
+_surrogate_state = {}
+
+
+# Set spectra and observed group-mean ISC for surrogate batches
+def _init_surrogates(spectra, valid, observed, n_TRs, method, block_size):
+    _surrogate_state.update({'spectra': spectra, 'valid': valid,
+                             'observed': observed, 'n_TRs': n_TRs,
+                             'method': method, 'block_size': block_size})
+
+
+# Count surrogates with group-mean ISC at or above the observed ISC
+def _surrogate_batch(seed, n_surrogates):
+    spectra = _surrogate_state['spectra']
+    invalid = ~_surrogate_state['valid'].T
+    observed = _surrogate_state['observed']
+    n_TRs, method = _surrogate_state['n_TRs'], _surrogate_state['method']
+    block_size = _surrogate_state['block_size']
+    n_freqs, n_voxels, n_subjects = spectra.shape
+    weights = _spectral_weights(n_TRs, n_freqs, spectra.real.dtype)
+
+    # Rotate one block of voxels at a time so each worker only holds a
+    # rotated copy of a block rather than of all spectra
+    prng = np.random.default_rng(seed)
+    counts = np.zeros(n_voxels, dtype=int)
+    for _ in np.arange(n_surrogates):
+        phases = _surrogate_phases(prng, method, n_TRs, n_freqs,
+                                   n_subjects).astype(spectra.dtype)
+        for start in np.arange(0, n_voxels, block_size):
+            block = slice(start, min(start + block_size, n_voxels))
+            null_iscs = _spectral_isc(spectra[:, block] *
+                                      phases[:, np.newaxis],
+                                      weights, n_TRs)
+            null_iscs[invalid[:, block]] = np.nan
+            counts[block] += _fisher_mean(null_iscs) >= observed[block]
+    return counts
+
+
+# Function for testing group-mean ISC against surrogate time series
+def surrogate_isc(data, n_surrogates=1000, method='phase', zscored=False,
+                  dtype=None, batch_size=100, n_workers=1,
+                  random_state=None, max_mem=None):
+    """Surrogate (phase-randomized or circularly shifted) test of ISC
+
+    Each subject's time series is transformed to the frequency domain
+    once. A surrogate rotates the phases of every subject's spectrum
+    independently, either with uniformly random phases (preserving the
+    power spectrum) or with the phase ramp of a random circular shift.
+    The same rotation is applied to all voxels of a subject, and ISCs
+    are computed directly from the rotated spectra, so no inverse FFT
+    or resampling of the time series is needed. The statistic is the
+    Fisher z-transformed mean of leave-one-out ISCs across subjects,
+    and one-sided p-values are (1 + number of surrogates at or above
+    the observed mean) / (1 + n_surrogates).
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Time series data (TRs x voxels x subjects) or (TRs x subjects)
+    n_surrogates : int, default: 1000
+        Number of surrogate datasets
+    method : str, default: 'phase'
+        Phase randomization ('phase') or random circular shifts ('shift')
+    zscored : bool, default: False
+        Whether input time series are already z-scored across TRs
+    dtype : np.dtype, optional
+        Compute in this precision (e.g. np.float32); defaults to the
+        precision of the input data
+    batch_size : int, default: 100
+        Number of surrogates per batch (the unit of parallel work)
+    n_workers : int, default: 1
+        Number of worker processes for surrogate batches
+    random_state : int, optional
+        Seed for reproducible surrogates (independent of n_workers)
+    max_mem : str or int, optional
+        Memory budget (e.g. '1GB') per worker for rotated spectra; each
+        surrogate is computed over blocks of voxels that fit within it
+        (by default all voxels at once)
+
+    Returns
+    -------
+    observed : np.ndarray
+        Fisher z-transformed mean ISC across subjects (voxels)
+    p_values : np.ndarray
+        One-sided surrogate p-values (voxels)
+
+    """
+    data = _check_data(data)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    if not zscored:
+        data = zscore(data, axis=0)
+    n_TRs = data.shape[0]
+
+    # Spectra of z-scored time series are reused across all surrogates
+    # (subjects with NaNs at a voxel are left out, as in isc)
+    observed = _fisher_mean(isc(data, zscored=True))
+    data, valid = _valid_subjects(data)
+    spectra = rfft(data, axis=0)
+    n_freqs, n_voxels, n_subjects = spectra.shape
+    if max_mem:
+        bytes_per_voxel = n_freqs * n_subjects * spectra.itemsize
+        block_size = max(1, parse_memory(max_mem) // bytes_per_voxel)
+    else:
+        block_size = n_voxels
+    _init_surrogates(spectra, valid, observed, n_TRs, method, block_size)
+
+    # Independent seeds per batch so results don't depend on n_workers
+    batches = [min(batch_size, n_surrogates - start)
+               for start in np.arange(0, n_surrogates, batch_size)]
+    seeds = np.random.SeedSequence(random_state).spawn(len(batches))
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=get_context('fork')) as pool:
+            counts = sum(pool.map(_surrogate_batch, seeds, batches))
+    else:
+        counts = sum(_surrogate_batch(seed, batch)
+                     for seed, batch in zip(seeds, batches))
+    _surrogate_state.clear()
+
+    p_values = (counts + 1) / (n_surrogates + 1)
+    p_values[np.isnan(observed)] = np.nan
+
+    return observed, p_values
+
+
+# Function for Benjamini-Hochberg false discovery rate thresholding
+def fdr_threshold(p_values, q=.05):
+    """Benjamini-Hochberg FDR control across voxels
+
+    Parameters
+    ----------
+    p_values : np.ndarray
+        P-values for each voxel (NaNs are ignored)
+    q : float, default: .05
+        False discovery rate
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of voxels surviving FDR correction
+
+    """
+    p_values = np.asarray(p_values)
+    valid = np.flatnonzero(~np.isnan(p_values))
+    order = valid[np.argsort(p_values[valid])]
+    thresholds = q * np.arange(1, len(order) + 1) / len(order)
+    below = np.flatnonzero(p_values[order] <= thresholds)
+
+    significant = np.zeros(p_values.shape, dtype=bool)
+    if len(below):
+        significant[order[:below[-1] + 1]] = True
+    return significant
+
+
+# Streaming Fisher z-transformed mean of correlation maps
+class FisherMean:
+    """Accumulate a NaN-aware Fisher z-transformed mean one map at a time
+
+    Only the running sum of Fisher z-values and the number of non-NaN
+    values per voxel are kept, so means over hundreds of ISC maps need
+    two (voxels) buffers rather than a stack of every map. The result
+    matches np.tanh(np.nanmean(np.arctanh(maps), axis=0)).
+
+    Examples
+    --------
+    >>> task_mean = FisherMean()
+    >>> for isc_fn in isc_fns:
+    ...     task_mean.add(read_gifti(isc_fn))
+    >>> write_gifti(task_mean.mean(), task_fn, isc_fns[0])
+
+    """
+
+    def __init__(self):
+        self.total = None
+        self.count = None
+        self.n_maps = 0
+
+    def add(self, correlations):
+        """Add a correlation map (e.g. one scan's ISCs) to the mean"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fisher_z = np.arctanh(np.asarray(correlations,
+                                             dtype=np.float64))
+        valid = ~np.isnan(fisher_z)
+        if self.total is None:
+            self.total = np.zeros(fisher_z.shape)
+            self.count = np.zeros(fisher_z.shape, dtype=int)
+        self.total += np.where(valid, fisher_z, 0)
+        self.count += valid
+        self.n_maps += 1
+        return self
+
+    def mean(self):
+        """Fisher z-transformed mean of all maps added so far"""
+        if self.total is None:
+            raise ValueError("No correlation maps have been added")
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.tanh(self.total / self.count)
+
+
+# Function for bootstrap confidence intervals of the Fisher mean ISC
+def bootstrap_fisher_mean(correlations, subjects, n_bootstraps=1000,
+                          ci=95, random_state=None):
+    """Subject-bootstrap confidence interval for Fisher mean correlations
+
+    Subjects (not scans) are resampled with replacement, so all runs of
+    a resampled subject enter together. Resampling counts are drawn once
+    as an (n_bootstraps x subjects) matrix, expanded to scans, and every
+    resampled mean of Fisher z-values is computed with a single matrix
+    product against the (scans x voxels) z-value matrix (NaNs are left
+    out of each mean, as in np.nanmean).
+
+    Parameters
+    ----------
+    correlations : np.ndarray
+        Correlation values (e.g. ISCs) for each scan (scans x voxels)
+    subjects : list
+        Subject for each scan
+    n_bootstraps : int, default: 1000
+        Number of bootstrap samples
+    ci : float, default: 95
+        Width of the percentile confidence interval
+    random_state : int, optional
+        Seed for reproducible resampling
+
+    Returns
+    -------
+    lower : np.ndarray
+        Lower bound of the confidence interval (voxels)
+    upper : np.ndarray
+        Upper bound of the confidence interval (voxels)
+
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fisher_z = np.arctanh(np.asarray(correlations))
+    if fisher_z.ndim == 1:
+        fisher_z = fisher_z[:, np.newaxis]
+    if len(subjects) != fisher_z.shape[0]:
+        raise ValueError("Expected one subject label per scan")
+    valid = ~np.isnan(fisher_z)
+    fisher_z = np.where(valid, fisher_z, 0)
+
+    # Resampling counts per subject, expanded to each subject's scans
+    labels, subject_index = np.unique(subjects, return_inverse=True)
+    prng = np.random.default_rng(random_state)
+    counts = prng.multinomial(len(labels), np.full(len(labels),
+                                                   1 / len(labels)),
+                              size=n_bootstraps)
+    weights = counts[:, subject_index].astype(fisher_z.dtype)
+
+    # All resampled means with one product (and one for NaN counts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.tanh((weights @ fisher_z) /
+                        (weights @ valid.astype(fisher_z.dtype)))
+
+    # Voxels without any valid ISCs (e.g. medial wall) stay NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lower, upper = np.nanpercentile(means, [(100 - ci) / 2,
+                                                100 - (100 - ci) / 2],
+                                        axis=0)
+    return lower, upper
+
+
+# Get a signature (modification time and size) for a scan if it's a file
+def _scan_signature(scan):
+    if exists(scan):
+        scan_stat = stat(scan)
+        return f'{scan_stat.st_mtime_ns}:{scan_stat.st_size}'
+    return ''
+
+
+# Function for leave-one-out ISC updated from persisted sums
+def incremental_isc(stats_fn, scans, load, params, zscored=False,
+                    dtype=None):
+    """Leave-one-out ISC updated incrementally as scans change
+
+    The sum of z-scored time series across scans and the membership
+    (with file signatures) of each scan are persisted to stats_fn.
+    When scans are added or removed (e.g. after scan_exclude.json or
+    a new cohort changes), only those scans are loaded to update the
+    sum, rather than re-accumulating it from every scan (if a scan's file
+    was modified since it was added, the sum is rebuilt). Because every
+    leave-one-out mean depends on the sum, all ISCs are then recomputed
+    in a single pass. If nothing changed, no data are loaded at all.
+    Changing params (e.g. event trimming) invalidates the statistics.
+
+    Parameters
+    ----------
+    stats_fn : str
+        Filename (.npz) for persisted sufficient statistics
+    scans : list
+        Scan identifiers (e.g. filenames) passed to load
+    load : callable
+        Function returning (TRs x voxels) data for a scan
+    params : dict
+        JSON-serializable parameters the statistics depend on
+        (e.g. onset, offset, initial_trim)
+    zscored : bool, default: False
+        Whether loaded time series are already z-scored across TRs
+    dtype : np.dtype, optional
+        Compute in this precision (e.g. np.float32)
+
+    Returns
+    -------
+    np.ndarray or None
+        Leave-one-out ISC values (subjects x voxels), or None if the
+        scans and parameters are unchanged since the last update
+
+    """
+    if len(scans) < 2:
+        raise ValueError("Leave-one-out ISC requires at least 2 subjects")
+
+    # Load and (optionally) z-score a single scan
+    def load_scan(scan):
+        subj_data = np.asarray(load(scan), dtype=dtype)
+        if subj_data.ndim == 1:
+            subj_data = subj_data[:, np.newaxis]
+        if not zscored:
+            subj_data = zscore(subj_data, axis=0)
+        return _valid_subjects(subj_data)
+
+    params = json.loads(json.dumps(params))
+    members = {scan: _scan_signature(scan) for scan in scans}
+
+    # Load persisted statistics if parameters still match
+    total, previous = None, {}
+    if exists(stats_fn):
+        with np.load(stats_fn) as stats:
+            state = json.loads(str(stats['state']))
+            if state['params'] == params:
+                total = stats['total']
+                previous = state['members']
+            else:
+                print(f"Parameters changed; recomputing {stats_fn}")
+
+    removed = [scan for scan in previous
+               if members.get(scan) != previous[scan]]
+    added = [scan for scan in members
+             if previous.get(scan) != members[scan]]
+
+    # Nothing to do if membership and files are unchanged
+    if total is not None and not removed and not added:
+        return None
+
+    # Removed scans can only be subtracted if their files are unchanged
+    # since they were added (a modified or missing file no longer holds
+    # the contribution in the sum), otherwise rebuild the sum
+    if any(_scan_signature(scan) != previous[scan] for scan in removed):
+        print(f"Removed scans modified or missing; recomputing {stats_fn}")
+        total, removed, added = None, [], list(members)
+
+    # Update the sum with only the changed scans
+    for scan in removed:
+        total = total - load_scan(scan)[0]
+    for scan in added:
+        subj_data, _ = load_scan(scan)
+
+        # Keep the persisted sum in double precision to avoid drift
+        if total is None:
+            total = np.zeros(subj_data.shape, dtype=np.float64)
+        total = total + subj_data
+
+    # Single pass to correlate each scan with its leave-one-out mean
+    n_TRs = total.shape[0]
+    compute_total = total.astype(dtype or total.dtype, copy=False)
+    total_total = np.einsum('tv,tv->v', compute_total, compute_total)
+    iscs = np.empty((len(scans), total.shape[1]),
+                    dtype=compute_total.dtype)
+    for s, scan in enumerate(scans):
+        subj_data, valid = load_scan(scan)
+        subject_total = np.einsum('tv,tv->v', subj_data, compute_total)
+        iscs[s] = _loo_correlation(subject_total, total_total, n_TRs)
+        iscs[s, ~valid] = np.nan
+
+    # Persist updated statistics (write to temporary file first)
+    state = json.dumps({'params': params, 'members': members})
+    tmp_fn = stats_fn.replace('.npz', f'.{getpid()}.tmp.npz')
+    np.savez(tmp_fn, total=total, state=np.array(state))
+    replace(tmp_fn, stats_fn)
+    print(f"Updated ISC statistics ({len(added)} added, "
+          f"{len(removed)} removed)")
+
+    return iscs
+
+
+# Function to check single- against double-precision ISC
+def compare_precision(data, lags=10, max_mem='64MB', n_surrogates=20):
+    """Maximum absolute differences between float32 and float64 results
+
+    Every entry point with a float32 option (stacked, streaming,
+    chunked, lagged and surrogate ISC) is run in both precisions on the
+    same (not yet z-scored) data.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Time series data (TRs x voxels x subjects) or (TRs x subjects)
+    lags : int, default: 10
+        Maximum lag for lagged ISC
+    max_mem : str or int, default: '64MB'
+        Memory budget for chunked ISC (small, so several blocks are used)
+    n_surrogates : int, default: 20
+        Number of surrogates (with a fixed seed) for surrogate ISC
+
+    Returns
+    -------
+    dict
+        Maximum absolute difference across subjects and voxels for each
+        entry point ('surrogate_p' compares surrogate p-values)
+
+    """
+    data = _check_data(data)
+    n_TRs, n_voxels, n_subjects = data.shape
+    scans = np.arange(n_subjects)
+
+    # Load one subject (or a block of its voxels) as a scan
+    def load(scan, vertices=slice(None)):
+        return data[:, vertices, scan]
+
+    results = {}
+    for dtype in [np.float64, np.float32]:
+        observed, p_values = surrogate_isc(data, n_surrogates=n_surrogates,
+                                           dtype=dtype, random_state=0)
+        results[dtype] = {
+            'isc': isc(data, dtype=dtype),
+            'streaming_isc': streaming_isc(scans, load, dtype=dtype),
+            'chunked_isc': chunked_isc(scans, load, n_voxels, n_TRs,
+                                       max_mem, dtype=dtype),
+            'lagged_isc': lagged_isc(data, lags=lags, dtype=dtype)[0],
+            'chunked_lagged_isc': chunked_lagged_isc(
+                scans, load, n_voxels, n_TRs, max_mem, lags=lags,
+                dtype=dtype)[1],
+            'surrogate_isc': observed, 'surrogate_p': p_values}
+
+    return {name: np.nanmax(np.abs(results[np.float64][name] -
+                                   results[np.float32][name].astype(
+                                       np.float64)))
+            for name in results[np.float64]}
+
+
+# Name guard for validating single-precision ISC on simulated data
+if __name__ == '__main__':
+
+    # Simulate a long story (e.g. 21styear) with a shared signal
+    tolerance = 1e-4
+    n_TRs, n_voxels, n_subjects = 2200, 500, 40
+    n_surrogates = 20
+    prng = np.random.RandomState(0)
+    signal = prng.randn(n_TRs, n_voxels, 1)
+    data = (signal * prng.uniform(0, 1, (1, n_voxels, 1)) +
+            prng.randn(n_TRs, n_voxels, n_subjects) * 2 + 100)
+
+    differences = compare_precision(data, n_surrogates=n_surrogates)
+    for name, difference in differences.items():
+        print(f"Maximum float32 vs. float64 {name} difference = "
+              f"{difference:.2e}")
+
+    # Surrogate counts may differ by one where a null ties the observed
+    p_tolerance = 1 / (n_surrogates + 1)
+    assert differences.pop('surrogate_p') <= p_tolerance + 1e-12
+    assert all(difference < tolerance
+               for difference in differences.values())
@@ -0,0 +1,235 @@
+import numpy as np
+from scipy.stats import zscore
+from isc_engine import _check_data, _valid_subjects, isc
+
+
+# Get z-scored data, the sum across (valid) subjects, leave-one-out norms
+# and (voxels x subjects) validity
+def _loo_terms(data, zscored=False, dtype=None):
+    data = _check_data(data)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    if not zscored:
+        data = zscore(data, axis=0)
+    data, valid = _valid_subjects(data)
+    n_TRs = data.shape[0]
+
+    # Sum across subjects and norms of each leave-one-out sum (subjects
+    # with NaNs at a voxel are zeroed, so only add their own norm if valid)
+    total = np.sum(data, axis=2)
+    subject_total = np.einsum('tvs,tv->sv', data, total)
+    total_total = np.einsum('tv,tv->v', total, total)
+    with np.errstate(invalid='ignore'):
+        others_norm = np.sqrt(n_TRs * (total_total - 2 * subject_total +
+                                       n_TRs * valid.T))
+
+    return data, total, others_norm, valid
+
+
+# Function to average vertex time series within parcels
+def parcel_timeseries(data, parcels):
+    """Average (TRs x vertices x subjects) data within parcels
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Time series data (TRs x vertices x subjects) or (TRs x vertices)
+    parcels : np.ndarray
+        Parcel label for each vertex (labels <= 0 are ignored)
+
+    Returns
+    -------
+    data : np.ndarray
+        Parcel-average time series (TRs x parcels x subjects)
+    labels : np.ndarray
+        Parcel label for each column
+
+    """
+    parcels = np.asarray(parcels)
+    labels = np.unique(parcels[parcels > 0])
+    indicator = (parcels[:, np.newaxis] == labels).astype(data.dtype)
+    indicator /= np.sum(indicator, axis=0)
+    return np.einsum('tv...,vp->tp...', data, indicator), labels
+
+
+# Function for leave-one-out ISFC between all pairs of parcels
+def isfc(data, zscored=False, symmetric=True, dtype=None):
+    """Leave-one-out intersubject functional connectivity (ISFC)
+
+    Each subject's time series in every parcel (or voxel) is correlated
+    with the mean time series of all other subjects in every parcel.
+    For z-scored data, the leave-one-out sum (total - x_s) is formed
+    from the sum across subjects computed once, and each subject's
+    (parcels x parcels) matrix is a single matrix product normalized by
+    the norms of the leave-one-out sums (as in isc_engine.isc). The
+    diagonal is the leave-one-out ISC. Subjects with NaNs in a parcel
+    are left out of the others' sums, and only their own rows for that
+    parcel (and columns, if symmetric) are NaN.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Time series data (TRs x parcels x subjects)
+    zscored : bool, default: False
+        Whether input time series are already z-scored across TRs
+    symmetric : bool, default: True
+        Average each matrix with its transpose (subject-to-others and
+        others-to-subject connectivity)
+    dtype : np.dtype, optional
+        Compute in this precision (e.g. np.float32); defaults to the
+        precision of the input data
+
+    Returns
+    -------
+    np.ndarray
+        Leave-one-out ISFC matrices (subjects x parcels x parcels)
+
+    """
+    data, total, others_norm, valid = _loo_terms(data, zscored=zscored,
+                                                 dtype=dtype)
+    n_TRs, n_parcels, n_subjects = data.shape
+
+    isfcs = np.empty((n_subjects, n_parcels, n_parcels), dtype=data.dtype)
+    for s in np.arange(n_subjects):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            isfcs[s] = (data[..., s].T @ (total - data[..., s]) /
+                        others_norm[s])
+        isfcs[s][~valid[:, s]] = np.nan
+    if symmetric:
+        isfcs = (isfcs + np.swapaxes(isfcs, 1, 2)) / 2
+
+    return isfcs
+
+
+# Function for vertex-wise group ISFC computed in blocks of vertices
+def blockwise_isfc(data, block_size=1024, top_k=None, parcels=None,
+                   zscored=False, dtype=None):
+    """Group-mean leave-one-out ISFC between vertices, reduced per block
+
+    The full (vertices x vertices) matrix for every subject is never
+    formed. For each block of seed vertices, every subject's (block x
+    vertices) ISFC is computed with one matrix product against its
+    leave-one-out sum and accumulated as a Fisher z-transformed mean
+    across subjects. Each block is then reduced to either its top_k
+    strongest connections per vertex (excluding the vertex itself) or
+    its mean connectivity with each parcel, so memory scales with
+    vertices x top_k (or vertices x parcels).
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Time series data (TRs x vertices x subjects)
+    block_size : int, default: 1024
+        Number of seed vertices per block
+    top_k : int, optional
+        Keep this many strongest connections per vertex
+    parcels : np.ndarray, optional
+        Parcel label for each vertex (labels <= 0 are ignored); keep the
+        mean Fisher z-transformed ISFC with each parcel
+    zscored : bool, default: False
+        Whether input time series are already z-scored across TRs
+    dtype : np.dtype, optional
+        Compute in this precision (e.g. np.float32)
+
+    Returns
+    -------
+    indices : np.ndarray
+        If top_k, vertex indices of strongest connections (vertices x
+        top_k), ordered from strongest
+    values : np.ndarray
+        If top_k, group-mean ISFC of those connections (vertices x
+        top_k); if parcels, group-mean ISFC with each parcel (vertices
+        x parcels)
+    labels : np.ndarray
+        If parcels, parcel label for each column of values
+
+    """
+    if (top_k is None) == (parcels is None):
+        raise ValueError("Specify exactly one of top_k or parcels")
+
+    data, total, others_norm, valid = _loo_terms(data, zscored=zscored,
+                                                 dtype=dtype)
+    n_TRs, n_vertices, n_subjects = data.shape
+
+    # Parcel-averaging matrix for Fisher z-values (NaNs are skipped)
+    if parcels is not None:
+        parcels = np.asarray(parcels)
+        labels = np.unique(parcels[parcels > 0])
+        indicator = (parcels[:, np.newaxis] == labels).astype(data.dtype)
+        values = np.empty((n_vertices, len(labels)), dtype=data.dtype)
+    else:
+        indices = np.empty((n_vertices, top_k), dtype=int)
+        values = np.empty((n_vertices, top_k), dtype=data.dtype)
+
+    for start in np.arange(0, n_vertices, block_size):
+        block = slice(start, min(start + block_size, n_vertices))
+
+        # Accumulate Fisher z-values across subjects for this block
+        fisher_z = np.zeros((block.stop - block.start, n_vertices),
+                            dtype=data.dtype)
+        count = np.zeros(fisher_z.shape, dtype=data.dtype)
+        for s in np.arange(n_subjects):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                block_z = np.arctanh(data[:, block, s].T @
+                                     (total - data[..., s]) /
+                                     others_norm[s])
+            block_z[~valid[block, s]] = np.nan
+            finite = np.isfinite(block_z)
+            fisher_z += np.where(finite, block_z, 0)
+            count += finite
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fisher_z /= count
+
+        if parcels is not None:
+            finite = ~np.isnan(fisher_z)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values[block] = np.tanh(
+                    (np.where(finite, fisher_z, 0) @ indicator) /
+                    (finite.astype(data.dtype) @ indicator))
+        else:
+            fisher_z[np.isnan(fisher_z)] = -np.inf
+            fisher_z[np.arange(fisher_z.shape[0]),
+                     np.arange(block.start, block.stop)] = -np.inf
+            top = np.argpartition(-fisher_z, top_k - 1, axis=1)[:, :top_k]
+            order = np.argsort(-np.take_along_axis(fisher_z, top, axis=1),
+                               axis=1)
+            indices[block] = np.take_along_axis(top, order, axis=1)
+            values[block] = np.tanh(np.take_along_axis(
+                fisher_z, indices[block], axis=1))
+
+    if parcels is not None:
+        return values, labels
+    return indices, values
+
+
+# Name guard for validating ISFC against ISC and dense ISFC
+if __name__ == '__main__':
+
+    # Simulate vertices sharing one of two signals across subjects
+    n_TRs, n_vertices, n_subjects = 300, 200, 10
+    prng = np.random.RandomState(0)
+    signals = prng.randn(n_TRs, 2, 1)
+    parcels = np.repeat([1, 2], n_vertices // 2)
+    data = (signals[:, parcels - 1] +
+            prng.randn(n_TRs, n_vertices, n_subjects) * 2)
+
+    # Diagonal of (non-symmetrized) ISFC is leave-one-out ISC
+    isfcs = isfc(data, symmetric=False)
+    difference = np.max(np.abs(np.diagonal(isfcs, axis1=1, axis2=2) -
+                               isc(data)))
+    print(f"Maximum ISFC diagonal vs. ISC difference = {difference:.2e}")
+    assert difference < 1e-10
+
+    # Blockwise top-k and parcel reductions match the dense ISFC
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dense = np.tanh(np.mean(np.arctanh(isfcs), axis=0))
+    indices, values = blockwise_isfc(data, block_size=64, top_k=5)
+    np.fill_diagonal(dense, -np.inf)
+    assert np.allclose(values, np.sort(dense, axis=1)[:, ::-1][:, :5])
+    assert np.all(parcels[indices] == parcels[:, np.newaxis])
+
+    parcel_values, labels = blockwise_isfc(data, block_size=64,
+                                           parcels=parcels)
+    print(f"Within-parcel ISFC = {parcel_values[:100, 0].mean():.3f}, "
+          f"between-parcel ISFC = {parcel_values[:100, 1].mean():.3f}")
+    assert np.all(parcel_values[:100, 0] > parcel_values[:100, 1])
@@ -0,0 +1,286 @@
+from os import getpid, makedirs, replace, stat
+from os.path import abspath, basename, exists, join
+from collections import OrderedDict
+from glob import glob
+import hashlib
+import numpy as np
+from scipy.stats import zscore
+from natsort import natsorted
+from afni_io import load_1D
+from confound_regression import cached_basis, regress_out, save_clean
+from exclude_scans import exclude_scan
+from gifti_io import read_gifti
+
+
+# Memoization of trimmed, z-scored time series (in memory and on disk;
+# both are off unless enabled with set_cache, since memoized arrays are
+# held in every worker process on top of the analysis memory budgets)
+cache = {'max_memory': 0, 'directory': None,
+         'memory': OrderedDict(), 'nbytes': 0}
+
+
+# Function to configure caching of trimmed, z-scored time series
+def set_cache(max_memory=4 * 1024 ** 3, directory=None):
+    """Configure in-memory (LRU) and on-disk caches for load_trimmed
+
+    Parameters
+    ----------
+    max_memory : int, default: 4 GB
+        Maximum bytes held in the in-memory LRU cache (0 disables it)
+    directory : str, optional
+        Directory for on-disk .npy cache; None disables it
+
+    """
+    cache['max_memory'] = max_memory
+    cache['directory'] = directory
+    cache['memory'].clear()
+    cache['nbytes'] = 0
+
+
+# Function to glob scans for a task (and group), excluding bad scans
+def collect_scans(data_dir, task, hemi, task_meta, suffix,
+                  space='fsaverage6', subtask=None, group=None,
+                  scan_exclude=None):
+    """Collect scan filenames and subject labels for a task
+
+    Parameters
+    ----------
+    data_dir : str
+        Derivatives directory containing sub-*/func/ (e.g. afni-smooth)
+    task : str
+        Task name (e.g. 'slumlordreach')
+    hemi : str
+        Hemisphere ('L' or 'R')
+    task_meta : dict
+        Task metadata (e.g. loaded from task_meta.json)
+    suffix : str
+        Filename suffix following hemi-{hemi}_ (e.g. 'desc-clean.func.gii'
+        or 'roi-EAC_desc-clean_timeseries.1D')
+    space : str, default: 'fsaverage6'
+        Surface space of input files
+    subtask : str, optional
+        Subtask used to look up group conditions; defaults to task
+    group : str, optional
+        Only include subjects with this condition (e.g. 'affair')
+    scan_exclude : dict, optional
+        Dictionary of scans to exclude (e.g. from scan_exclude.json)
+
+    Returns
+    -------
+    subject_list : list
+        Subject for each scan
+    run_list : list
+        Basename of each scan
+    fn_list : list
+        Full filename of each scan
+
+    """
+    subtask = subtask or task
+    subject_list, run_list, fn_list = [], [], []
+    for subject in sorted(task_meta[task].keys()):
+
+        # Skip the subjects not belonging to this group
+        if group and group != task_meta[subtask][subject]['condition']:
+            continue
+
+        fns = natsorted(glob(join(data_dir, subject, 'func',
+                                  (f'{subject}_task-{task}_*space-{space}_'
+                                   f'hemi-{hemi}_{suffix}'))))
+
+        # Grab all runs in case of multiple runs
+        for fn in fns:
+            if scan_exclude and exclude_scan(fn, scan_exclude):
+                print(f"Excluding {basename(fn)}!")
+                continue
+
+            subject_list.append(subject)
+            run_list.append(basename(fn))
+            fn_list.append(fn)
+
+    return subject_list, run_list, fn_list
+
+
+# Store trimmed data in the in-memory LRU cache (vertex blocks are read
+# once per analysis, so they are not kept)
+def _memory_store(key, data, block=False):
+    data.flags.writeable = False
+    if block or data.nbytes > cache['max_memory']:
+        return
+    cache['memory'][key] = data
+    cache['nbytes'] += data.nbytes
+    while cache['nbytes'] > cache['max_memory']:
+        _, evicted = cache['memory'].popitem(last=False)
+        cache['nbytes'] -= evicted.nbytes
+
+
+# Function to load, trim and z-score a single scan (memoized)
+def load_trimmed(fn, onset, offset, initial_trim=0, dtype=np.float64,
+                 vertices=slice(None), model_fn=None, polort=2,
+                 clean_fn=None):
+    """Load time series, trim by event onset/offset and z-score
+
+    Results can be memoized in memory (LRU capped by set_cache; whole
+    scans only) and on disk, keyed by filename, modification time, size
+    and trimming parameters, so repeated analyses read each scan once.
+    Returned arrays are read-only.
+
+    If model_fn is given, fn is uncleaned (e.g. smoothed) data and the
+    confound model plus Legendre trends are regressed out of the full
+    scan in memory (as in run_regression.py) before trimming, so no
+    intermediate desc-clean file is needed.
+
+    Parameters
+    ----------
+    fn : str
+        GIfTI (.gii) or AFNI 1D (.1D) time series filename
+    onset : int
+        Event onset in TRs
+    offset : int
+        Event offset (onset + duration) in TRs
+    initial_trim : int, default: 0
+        Number of TRs to drop after event onset
+    dtype : np.dtype, default: np.float64
+        Precision of returned data
+    vertices : slice, default: slice(None)
+        Vertex columns to load from GIfTI files
+    model_fn : str, optional
+        Model regressors 1D file to regress out before trimming
+    polort : int, default: 2
+        Maximum Legendre polynomial degree for confound regression
+    clean_fn : str, optional
+        Also save the cleaned (untrimmed) time series to this file
+        (requires model_fn and all vertices)
+
+    Returns
+    -------
+    np.ndarray
+        Z-scored time series (TRs) or (TRs x vertices)
+
+    """
+    if clean_fn and (not model_fn or vertices != slice(None)):
+        raise ValueError("Saving cleaned data requires model_fn and "
+                         "all vertices")
+
+    fn_stat = stat(fn)
+    key = (abspath(fn), fn_stat.st_mtime_ns, fn_stat.st_size, onset,
+           offset, initial_trim, np.dtype(dtype).str,
+           vertices.start, vertices.stop, vertices.step)
+    if model_fn:
+        model_stat = stat(model_fn)
+        key += (abspath(model_fn), model_stat.st_mtime_ns,
+                model_stat.st_size, polort)
+
+    # Check in-memory cache, then on-disk cache
+    if key in cache['memory']:
+        cache['memory'].move_to_end(key)
+        return cache['memory'][key]
+
+    if cache['directory']:
+        cache_fn = join(cache['directory'], hashlib.sha1(
+            repr(key).encode()).hexdigest() + '.npy')
+        if exists(cache_fn):
+            data = np.load(cache_fn)
+            _memory_store(key, data, block=vertices != slice(None))
+            return data
+
+    # Regress confounds out of the full scan before trimming
+    if model_fn:
+        if fn.endswith('.1D'):
+            data = load_1D(fn)[:, np.newaxis]
+        else:
+            data = read_gifti(fn, lazy=True)[:, vertices]
+        data = regress_out(data, cached_basis(model_fn, data.shape[0],
+                                              polort=polort))
+        if clean_fn:
+            save_clean(data, clean_fn, {'template_fn': fn})
+        if fn.endswith('.1D'):
+            data = data[:, 0]
+        data = data[onset:offset][initial_trim:]
+
+    # Trim data based on event onset and duration (and initial TRs)
+    elif fn.endswith('.1D'):
+        data = load_1D(fn)[onset:offset][initial_trim:]
+    else:
+        data = read_gifti(fn, lazy=True)[onset:offset, vertices]
+        data = data[initial_trim:, :]
+
+    # Z-score input time series
+    data = zscore(np.asarray(data, dtype=dtype), axis=0)
+
+    if cache['directory']:
+        makedirs(cache['directory'], exist_ok=True)
+        tmp_fn = cache_fn.replace('.npy', f'.{getpid()}.tmp.npy')
+        np.save(tmp_fn, data)
+        replace(tmp_fn, cache_fn)
+    _memory_store(key, data, block=vertices != slice(None))
+
+    return data
+
+
+# Function to load trimmed, z-scored time series for a task (and group)
+def load_task(data_dir, task, hemi, task_meta, event_meta, suffix,
+              space='fsaverage6', subtask=None, group=None,
+              initial_trim=0, scan_exclude=None, dtype=np.float64):
+    """Load trimmed, z-scored time series for all scans in a task
+
+    Parameters
+    ----------
+    data_dir : str
+        Derivatives directory containing sub-*/func/ (e.g. afni-smooth)
+    task : str
+        Task name (e.g. 'slumlordreach')
+    hemi : str
+        Hemisphere ('L' or 'R')
+    task_meta : dict
+        Task metadata (e.g. loaded from task_meta.json)
+    event_meta : dict
+        Event onsets and durations (e.g. loaded from event_meta.json)
+    suffix : str
+        Filename suffix following hemi-{hemi}_ (see collect_scans)
+    space : str, default: 'fsaverage6'
+        Surface space of input files
+    subtask : str, optional
+        Subtask for event trimming (e.g. 'slumlord'); defaults to task
+    group : str, optional
+        Only include subjects with this condition (e.g. 'affair')
+    initial_trim : int, default: 0
+        Number of TRs to drop after event onset
+    scan_exclude : dict, optional
+        Dictionary of scans to exclude (e.g. from scan_exclude.json)
+    dtype : np.dtype, default: np.float64
+        Precision of returned data
+
+    Returns
+    -------
+    data : np.ndarray
+        Time series (TRs x scans) for 1D inputs or (TRs x vertices x
+        scans) for GIfTI inputs
+    subject_list : list
+        Subject for each scan
+    run_list : list
+        Basename of each scan
+
+    """
+    subtask = subtask or task
+    onset = event_meta[task][subtask]['onset']
+    offset = onset + event_meta[task][subtask]['duration']
+
+    subject_list, run_list, fn_list = collect_scans(
+        data_dir, task, hemi, task_meta, suffix, space=space,
+        subtask=subtask, group=group, scan_exclude=scan_exclude)
+
+    # Fill one preallocated matrix with each trimmed 1D time series (raw
+    # scans may differ in length beyond the event offset)
+    if suffix.endswith('.1D'):
+        data = np.empty((offset - onset - initial_trim, len(fn_list)),
+                        dtype=dtype)
+        for i, fn in enumerate(fn_list):
+            data[:, i] = load_trimmed(fn, onset, offset,
+                                      initial_trim=initial_trim,
+                                      dtype=dtype)
+    else:
+        data = np.dstack([load_trimmed(fn, onset, offset,
+                                       initial_trim=initial_trim,
+                                       dtype=dtype) for fn in fn_list])
+
+    return data, subject_list, run_list
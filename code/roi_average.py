@@ -2,7 +2,9 @@ from os.path import basename, join
 import json
 import numpy as np
 from glob import glob
+from afni_io import write_1D
 from gifti_io import read_gifti
+from surface_store import load_scan
 
 space = 'fsaverage6'
 roi = 'EAC'
@@ -12,6 +14,11 @@ base_dir = '/jukebox/hasson/snastase/narratives'
 afni_dir = join(base_dir, 'derivatives', 'afni-nosmooth')
 tpl_dir = join(afni_dir, f'tpl-{space}')
 
+# Optionally read ROI vertices from an HDF5 store of fMRIPrep outputs
+# (built by running surface_store.py)
+use_store = False
+store_fn = join(afni_dir, f'group_space-{space}_desc-preproc_bold.h5')
+
 
 # Load subject metadata to get filenames
 with open(join(base_dir, 'code', 'subject_meta.json')) as f:
@@ -44,15 +51,22 @@ for hemi in ['L', 'R']:
 
         # Loop through BOLD images and extract ROI
         for bold_fn in bold_fns:
-            bold_map = read_gifti(bold_fn)
-            roi_avg = np.nanmean(bold_map[:, roi_mask == 1], axis=1)
-            assert bold_map.shape[0] == roi_avg.shape[0]
+            if use_store:
+                task = basename(bold_fn).split('task-')[1].split('_')[0]
+                roi_data = load_scan(store_fn, task, hemi,
+                                     basename(bold_fn).split('_space')[0],
+                                     vertices=roi_mask == 1)
+            else:
+                bold_map = read_gifti(bold_fn, lazy=True)
+                roi_data = bold_map[:, roi_mask == 1]
+            roi_avg = np.nanmean(roi_data, axis=1)
+            assert roi_data.shape[0] == roi_avg.shape[0]
 
             roi_1D = join(subject_dir,
                           basename(bold_fn).replace(
                               '.func.gii',
                               f'_roi-{roi}_desc-mean_timeseries.1D'))
-            np.savetxt(roi_1D, roi_avg[None, :], delimiter=' ', fmt='%f')
+            write_1D(roi_avg, roi_1D)
 
             print(f"Extracted average {roi} time series for {subject}"
                    f"\n  {basename(roi_1D)}")
\ No newline at end of file
@@ -1,21 +1,29 @@
-from os.path import basename, join
+from os.path import join
 import json
-from glob import glob
 import numpy as np
 from scipy.stats import pearsonr, zscore
-from brainiak.isc import isc
-from natsort import natsorted
-from exclude_scans import exclude_scan
+from isc_engine import isc
+from surface_store import load_block
+from exclude_scans import ExclusionIndex
+from load_timeseries import load_task
 
 space = 'fsaverage6'
 roi = 'EAC'
 afni_pipe = 'afni-nosmooth'
 initial_trim = 6
 
+# Precision for loading, z-scoring and ISC (cheap for ROI time series)
+dtype = np.float64
+
 base_dir = '/jukebox/hasson/snastase/narratives'
 deriv_dir = join(base_dir, 'derivatives')
 preproc_dir = join(deriv_dir, 'fmriprep')
 afni_dir = join(base_dir, 'derivatives', afni_pipe)
+tpl_dir = join(afni_dir, f'tpl-{space}')
+
+# Optionally average ROI vertices from the consolidated HDF5 store
+use_store = False
+store_fn = join(afni_dir, f'group_space-{space}_desc-clean_bold.h5')
 
 
 # Get metadata for all subjects for a given task
@@ -31,18 +39,9 @@ with open(join(base_dir, 'code', 'event_meta.json')) as f:
 # Load scans to exclude
 exclude = True
 with open(join(base_dir, 'code', 'scan_exclude.json')) as f:
-    scan_exclude = json.load(f)
+    scan_exclude = ExclusionIndex(json.load(f))
 
 
-# Helper function to load in AFNI's 3dTproject 1D outputs
-def load_1D(fn):
-    with open(fn) as f:
-        lines = [line.strip().split(' ') for line in f.readlines()
-                 if '#' not in line]
-    assert len(lines) == 1
-    return np.array(lines[0]).astype(float)
-        
-
 # Compile ROI ISCs across all subjects
 results = {}
 for task in task_meta:
@@ -73,13 +72,6 @@ for task in task_meta:
         else:
             groups = [None]
 
-        # Grab event onsets and offsets for trimming
-        onset = event_meta[task][subtask]['onset']
-        offset = onset + event_meta[task][subtask]['duration']
-
-        # Get a convenience subject list for this task
-        subjects = sorted(task_meta[task].keys())
-        
         # Loop through hemispheres
         for hemi in ['L', 'R']:
             results[subtask][hemi] = {}
@@ -87,50 +79,29 @@ for task in task_meta:
             # Loop through potential group manipulations (milkyway, paranoia)
             for group in groups:
 
-                # Create lists for storing subjects and run filenames
-                subject_list, run_list = [], []
-                data = []
-                for subject in subjects:
-
-                    # Skip the subjects not belonging to this group
-                    if group and group != task_meta[subtask][
-                                              subject]['condition']:
-                        continue
-                    
-                    data_dir = join(afni_dir, subject, 'func')
-
-                    roi_fns = natsorted(glob(join(data_dir,
-                                  (f'{subject}_task-{task}_*space-{space}_'
-                                   f'hemi-{hemi}_roi-{roi}_desc-clean_'
-                                   'timeseries.1D'))))
-
-                    # Grab all runs in case of multiple runs
-                    for roi_fn in roi_fns:
-                        
-                        if exclude and exclude_scan(roi_fn, scan_exclude):
-                            print(f"Excluding {basename(roi_fn)}!")
-                            continue
-
-                        else:
-
-                            # Strip comments and load in data as numpy array
-                            subj_data = load_1D(roi_fn)
-
-                            # Trim data based on event onset and duration
-                            subj_data = subj_data[onset:offset]
-                            subj_data = subj_data[initial_trim:]
-
-                            # Z-score input time series
-                            subj_data = zscore(subj_data)
-
-                            subject_list.append(subject)
-                            run_list.append(basename(roi_fn))
-                            data.append(subj_data)
-
-                data = np.column_stack(data)
+                # Average ROI vertices pulled from the consolidated store
+                if use_store:
+                    roi_mask = np.load(join(tpl_dir,
+                        f'tpl-{space}_hemi-{hemi}_desc-{roi}_mask.npy'))
+                    data, subject_list, run_list = load_block(
+                        store_fn, task, hemi, subtask=subtask, group=group,
+                        vertices=roi_mask, initial_trim=initial_trim,
+                        scan_exclude=scan_exclude if exclude else None)
+                    data = zscore(np.nanmean(data, axis=1).astype(dtype),
+                                  axis=0)
+
+                # Otherwise load each scan's ROI 1D file
+                else:
+                    data, subject_list, run_list = load_task(
+                        afni_dir, task, hemi, task_meta, event_meta,
+                        f'roi-{roi}_desc-clean_timeseries.1D', space=space,
+                        subtask=subtask, group=group,
+                        initial_trim=initial_trim,
+                        scan_exclude=scan_exclude if exclude else None,
+                        dtype=dtype)
 
                 # Compute ISCs
-                iscs = isc(data).flatten()
+                iscs = isc(data, zscored=True, dtype=dtype).flatten()
                 
                 # Print group-specific ISC notification
                 if group:
@@ -1,12 +1,9 @@
-from os.path import basename, join
+from os.path import join
 import json
-from glob import glob
 import numpy as np
-from scipy.stats import zscore
-from natsort import natsorted
-from brainiak.isc import (isc, _check_timeseries_input,
-                          compute_summary_statistic)
-from exclude_scans import exclude_scan
+from isc_engine import lagged_isc
+from exclude_scans import ExclusionIndex
+from load_timeseries import load_task
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -17,6 +14,9 @@ afni_pipe = 'afni-nosmooth'
 initial_trim = 6
 lags = 30
 
+# Precision for loading, z-scoring and ISC (cheap for ROI time series)
+dtype = np.float64
+
 base_dir = '/jukebox/hasson/snastase/narratives'
 deriv_dir = join(base_dir, 'derivatives')
 preproc_dir = join(deriv_dir, 'fmriprep')
@@ -36,78 +36,7 @@ with open(join(base_dir, 'code', 'event_meta.json')) as f:
 # Load scans to exclude
 exclude = True
 with open(join(base_dir, 'code', 'scan_exclude.json')) as f:
-    scan_exclude = json.load(f)
-
-
-# Helper function to load in AFNI's 3dTproject 1D outputs
-def load_1D(fn):
-    with open(fn) as f:
-        lines = [line.strip().split(' ') for line in f.readlines()
-                 if '#' not in line]
-    assert len(lines) == 1
-    return np.array(lines[0]).astype(float)
-
-
-# Function for computing ISCs at varying lags
-def lagged_isc(data, lags=20, circular=True,
-               subjects=None, summary_statistic=None):
-    
-    # Check response time series input format
-    data, n_TRs, n_voxels, n_subjects = _check_timeseries_input(data)
-        
-    # If lag is integer, get positive and negative range around zero
-    if type(lags) is int:
-        lags = np.arange(-lags, lags + 1)
-
-    # Iterate through lags to populate lagged ISCs
-    lagged_iscs = []
-    for lag in lags:
-
-        lagged_isc = []
-        for s in np.arange(n_subjects):
-            
-            lagged_subject = data[..., s]
-            lagged_mean = np.mean(np.delete(data, s, 2), axis=2)
-            
-            # If circular, loop excess elements to beginning
-            if circular:
-                if lag != 0:
-                    lagged_subject = np.concatenate((lagged_subject[-lag:, :],
-                                                     lagged_subject[:-lag, :]))
-                    
-            # If not circular, trim non-overlapping elements
-            # Shifts y with respect to x
-            else:
-                if lag < 0:
-                    lagged_subject = lagged_subject[:lag, :]
-                    lagged_mean = lagged_mean[-lag:, :]
-                elif lag > 0:
-                    lagged_subject = lagged_subject[lag:, :]
-                    lagged_mean = lagged_mean[:-lag, :]
-                    
-            loo_isc = isc(np.dstack((lagged_subject, lagged_mean)))
-            lagged_isc.append(loo_isc)
-            
-        lagged_iscs.append(np.dstack(lagged_isc))
-    
-    lagged_iscs = np.vstack(lagged_iscs)
-    
-    # Compute lag for maximum ISC per subject
-    peak_lags = []
-    for lagged_subject in np.moveaxis(lagged_iscs, 2, 0):
-        np.argmax(lagged_subject)
-        peak_lags.append(int(lags[np.argmax(lagged_subject)]))
-    if subjects:
-        peak_lags = {subject: peak_lag for subject, peak_lag
-                     in zip(subjects, peak_lags)}
-        
-    # Optionally summarize across subjects
-    if summary_statistic:
-        lagged_iscs = compute_summary_statistic(lagged_isc,
-                            summary_statistic=summary_statistic,
-                            axis=2)
-    
-    return lagged_iscs, peak_lags
+    scan_exclude = ExclusionIndex(json.load(f))
 
 
 # Helper function for visualizing lagged ISCs
@@ -175,13 +104,6 @@ for task in task_meta:
         else:
             groups = [None]
 
-        # Grab event onsets and offsets for trimming
-        onset = event_meta[task][subtask]['onset']
-        offset = onset + event_meta[task][subtask]['duration']
-
-        # Get a convenience subject list for this task
-        subjects = sorted(task_meta[task].keys())
-
         # Loop through hemispheres
         for hemi in ['L', 'R']:
             results[subtask][hemi] = {'lagged ISCs': {},
@@ -190,51 +112,19 @@ for task in task_meta:
             # Loop through potential group manipulations (milkyway, paranoia)
             for group in groups:
 
-                # Create lists for storing subjects and run filenames
-                subject_list, run_list = [], []
-                data = []
-                for subject in subjects:
-
-                    # Skip the subjects not belonging to this group
-                    if group and group != task_meta[subtask][
-                                              subject]['condition']:
-                        continue
-
-                    data_dir = join(afni_dir, subject, 'func')
-
-                    roi_fns = natsorted(glob(join(data_dir,
-                                  (f'{subject}_task-{task}_*space-{space}_'
-                                   f'hemi-{hemi}_roi-{roi}_desc-clean_'
-                                   'timeseries.1D'))))
-
-                    # Grab all runs in case of multiple runs
-                    for roi_fn in roi_fns:
-
-                        if exclude and exclude_scan(roi_fn, scan_exclude):
-                            print(f"Excluding {basename(roi_fn)}!")
-                            continue
-
-                        else:
-
-                            # Strip comments and load in data as numpy array
-                            subj_data = load_1D(roi_fn)
-
-                            # Trim data based on event onset and duration
-                            subj_data = subj_data[onset:offset]
-                            subj_data = subj_data[initial_trim:]
-
-                            # Z-score input time series
-                            subj_data = zscore(subj_data)
-
-                            subject_list.append(subject)
-                            run_list.append(basename(roi_fn))
-                            data.append(subj_data)
-
-                data = np.column_stack(data)
-
-                # Compute lagged ISCs
-                lagged_iscs, peak_lags = lagged_isc(data, lags=lags)
-                lagged_iscs = np.squeeze(lagged_iscs)
+                # Load trimmed, z-scored ROI time series
+                data, subject_list, run_list = load_task(
+                    afni_dir, task, hemi, task_meta, event_meta,
+                    f'roi-{roi}_desc-clean_timeseries.1D', space=space,
+                    subtask=subtask, group=group, initial_trim=initial_trim,
+                    scan_exclude=scan_exclude if exclude else None,
+                    dtype=dtype)
+
+                # Compute lagged ISCs (and peak lags) for all subjects
+                lagged_iscs, peak_lags = lagged_isc(data, lags=lags,
+                                                    zscored=True,
+                                                    dtype=dtype)
+                lagged_iscs, peak_lags = lagged_iscs[:, 0], peak_lags[0]
                 
                 # Print group-specific ISC notification
                 if group:
@@ -260,6 +150,8 @@ for task in task_meta:
                     else:
                         isc_dict[s][fn] = r.tolist()
 
+                    # Peak lag is undefined (null) if all lags are NaN
+                    p = None if np.isnan(p) else int(p)
                     if s not in peak_dict:
                         peak_dict[s] = {fn: p}
                     else:
@@ -3,11 +3,15 @@ from os import chdir
 import json
 from glob import glob
 from subprocess import run
+from confound_regression import clean_run
 
 
 space = 'fsaverage6'
 roi = 'EAC'
 
+# Regress confounds in NumPy (or set True to shell out to 3dTproject)
+use_afni = False
+
     
 # Assign some directories
 afni_pipe = 'afni-nosmooth'
@@ -32,21 +36,30 @@ for subject in subject_meta:
                          (f'{subject}_task-*_space-{space}_hemi-*_'
                           f'roi-{roi}_desc-mean_timeseries.1D')))
     
-    # Loop through BOLD ROI time series (tasks and runs)
+    # Group ROI time series by run (tasks and runs)
+    run_targets = {}
     for bold_fn in bold_fns:
+        clean_fn = join(afni_dir,
+                        basename(bold_fn).replace('desc-mean',
+                                                  'desc-clean'))
+        run_targets.setdefault(basename(bold_fn).split('_space')[0],
+                               []).append((bold_fn, clean_fn, None))
+
+    # Loop through runs and clean all ROI time series for each at once
+    for run_name, targets in run_targets.items():
         
         # Get corresponding model regressors filename
         model_fn = join(afni_dir,
-                        (basename(bold_fn).split('_space')[0] + 
-                        '_desc-model_regressors.1D'))
+                        run_name + '_desc-model_regressors.1D')
         assert exists(model_fn)
-        
-        clean_fn = join(afni_dir,
-                        basename(bold_fn).replace('desc-mean',
-                                                  'desc-clean'))
 
-        run(f"3dTproject -input {bold_fn} -ort {model_fn} -TR 1.5 "
-            f"-prefix {clean_fn} -polort 2 -overwrite", shell=True)
+        if use_afni:
+            for bold_fn, clean_fn, _ in targets:
+                run(f"3dTproject -input {bold_fn} -ort {model_fn} -TR 1.5 "
+                    f"-prefix {clean_fn} -polort 2 -overwrite", shell=True)
+        else:
+            clean_run(targets, model_fn, polort=2)
 
-        print(f"Finished model confound regression(s) for {subject}:"
-              f"\n  {basename(clean_fn)}")
+        for _, clean_fn, _ in targets:
+            print(f"Finished model confound regression(s) for {subject}:"
+                  f"\n  {basename(clean_fn)}")
@@ -1,22 +1,84 @@
-from os.path import basename, join
+from os.path import basename, dirname, join
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+from multiprocessing import get_context
 import json
 from glob import glob
 import numpy as np
 from scipy.stats import pearsonr, zscore
-from brainiak.isc import isc
+from isc_engine import (FisherMean, bootstrap_fisher_mean, chunked_isc,
+                        dynamic_isc, fdr_threshold, incremental_isc, isc,
+                        parse_memory, streaming_isc, surrogate_isc)
 from natsort import natsorted
-from exclude_scans import exclude_scan
+from exclude_scans import ExclusionIndex, exclude_scan
 from gifti_io import read_gifti, write_gifti
+from surface_store import load_scan, store_index
+from load_timeseries import cache as timeseries_cache
+from load_timeseries import collect_scans, load_trimmed
 
 space = 'fsaverage6'
 afni_pipe = 'afni-smooth'
 initial_trim = 6
 
+# Precision for loading, z-scoring and ISC (float64 for validation)
+dtype = np.float32
+
 base_dir = '/jukebox/hasson/snastase/narratives'
 deriv_dir = join(base_dir, 'derivatives')
 preproc_dir = join(deriv_dir, 'fmriprep')
 afni_dir = join(base_dir, 'derivatives', afni_pipe)
 
+# Optionally read from the consolidated HDF5 store (see surface_store.py)
+use_store = False
+store_fn = join(afni_dir, f'group_space-{space}_desc-clean_bold.h5')
+
+# Optionally stream over scans (two passes) rather than stacking all
+# subjects, so memory is two (TRs x vertices) buffers per task
+streaming = False
+
+# Optionally compute ISC in vertex blocks sized to a memory budget
+# (e.g. max_mem = '4GB'); only those vertex columns are read per block
+max_mem = None
+n_vertices = 40962
+
+# Optionally clean (confound regression), trim and z-score each smoothed
+# scan in memory rather than reading desc-clean files written by
+# run_regression.py (optionally also saving the cleaned time series)
+fused = False
+smooth_suffix = 'desc-sm6.func.gii'
+save_clean = False
+polort = 2
+scan_suffix = smooth_suffix if fused else 'desc-clean.func.gii'
+
+# Optionally persist per-task sums of z-scored time series so that adding
+# or excluding scans only loads the changed scans (plus one pass for ISC)
+incremental = False
+
+# Number of worker processes for task/hemisphere/group units, and the
+# total memory they may use at once (units are estimated from TRs x
+# vertices x subjects)
+n_workers = 1
+total_mem = '64GB'
+
+# Optionally test group-mean ISC per unit against phase-randomized
+# ('phase') or circularly shifted ('shift') surrogates, saving p-value
+# and FDR-thresholded mean ISC maps (this loads all scans for the unit)
+n_surrogates = None
+surrogate_method = 'phase'
+surrogate_workers = 1
+fdr_q = .05
+
+# Optionally resample subjects to save lower/upper confidence interval
+# maps alongside each task and global mean ISC map
+n_bootstraps = None
+ci = 95
+
+# Optionally compute sliding-window (dynamic) ISC with windows of this
+# many TRs, saving (windows x vertices) maps per scan and a group mean
+# time course per unit (this loads all scans for the unit)
+dynamic_width = None
+dynamic_step = 1
+
 
 # Get metadata for all subjects for a given task
 with open(join(base_dir, 'code', 'task_meta.json')) as f:
@@ -31,7 +93,7 @@ with open(join(base_dir, 'code', 'event_meta.json')) as f:
 # Load scans to exclude
 exclude = True
 with open(join(base_dir, 'code', 'scan_exclude.json')) as f:
-    scan_exclude = json.load(f)
+    scan_exclude = ExclusionIndex(json.load(f))
         
 
 # Skip 'notthefall' scramble and 'schema' tasks for simplicity
@@ -39,7 +101,221 @@ skip_tasks = ['notthefalllongscram', 'notthefallshortscram',
               'schema']
 
 
-# Compile whole-brain ISCs across all subjects
+# Collect scans for a task/group from the HDF5 store index
+def store_scans(task, hemi, group=None):
+    subject_list, run_list, scan_list = [], [], []
+    index, _ = store_index(store_fn, task, hemi)
+    for scan in index:
+        if group and group != scan['condition']:
+            continue
+
+        if exclude and exclude_scan(scan['source'], scan_exclude):
+            print(f"Excluding {scan['source']}!")
+            continue
+
+        subject_list.append(scan['subject'])
+        run_list.append(scan['source'])
+        scan_list.append(scan['scan'])
+
+    return subject_list, run_list, scan_list
+
+
+# Load, trim and z-score data for a single scan
+def load_data(scan, task, hemi, onset, offset, vertices=slice(None)):
+
+    # Trim data based on event onset and duration (and initial TRs)
+    if use_store:
+        subj_data = load_scan(store_fn, task, hemi, scan,
+                              rows=slice(onset + initial_trim, offset),
+                              vertices=vertices)
+        subj_data = zscore(np.asarray(subj_data, dtype=dtype), axis=0)
+
+    # Shared loader memoizes trimmed, z-scored GIfTI data (optionally
+    # regressing out the run's confound model first)
+    elif fused:
+        model_fn = join(dirname(scan), basename(scan).split('_space')[0] +
+                        '_desc-model_regressors.1D')
+        clean_fn = (scan.replace(scan_suffix, 'desc-clean.func.gii')
+                    if save_clean and vertices == slice(None) else None)
+        subj_data = load_trimmed(scan, onset, offset,
+                                 initial_trim=initial_trim, dtype=dtype,
+                                 vertices=vertices, model_fn=model_fn,
+                                 polort=polort, clean_fn=clean_fn)
+    else:
+        subj_data = load_trimmed(scan, onset, offset,
+                                 initial_trim=initial_trim, dtype=dtype,
+                                 vertices=vertices)
+    print(f"Loaded {basename(scan)} ({hemi}) for ISC analysis")
+
+    return subj_data
+
+
+# Get group-level output filename for a unit (e.g. 'desc-pvalue_isc.gii')
+def unit_fn(unit, suffix):
+    return join(afni_dir, (f'group_task-{unit["subtask"]}_space-{space}_'
+                           f'hemi-{unit["hemi"]}_' +
+                           (f'group-{unit["group"]}_'
+                            if unit['group'] else '') + suffix))
+
+
+# Estimate peak memory (in bytes) for computing one ISC unit
+def unit_memory(unit):
+    itemsize = np.dtype(dtype).itemsize
+    n_TRs = unit['offset'] - unit['onset'] - initial_trim
+
+    # Each worker also holds its own memoized scans (see set_cache in
+    # load_timeseries.py; off by default)
+    memo = timeseries_cache['max_memory']
+    n_scans = len(unit['scans'])
+    if max_mem:
+        memory = parse_memory(max_mem)
+    elif streaming or incremental:
+        memory = 3 * n_TRs * n_vertices * itemsize
+    else:
+        memory = (2 * n_scans + 1) * n_TRs * n_vertices * itemsize
+
+    # Surrogate and dynamic ISC stack all scans even when streaming or
+    # chunking; surrogates add (complex) spectra of all scans plus a
+    # rotated block of them per surrogate worker, and dynamic ISC adds
+    # the sliding-window ISCs of every scan
+    stacked = n_scans * n_TRs * n_vertices * itemsize
+    if n_surrogates:
+        spectra = (n_TRs // 2 + 1) * n_vertices * n_scans * 2 * itemsize
+        rotated = min(parse_memory(max_mem), spectra) if max_mem else spectra
+        memory = max(memory,
+                     stacked + spectra + surrogate_workers * rotated)
+    if dynamic_width:
+        n_windows = (n_TRs - dynamic_width) // dynamic_step + 1
+        memory = max(memory, stacked +
+                     n_scans * n_windows * n_vertices * itemsize)
+    return memory + memo
+
+
+# Compute and save ISCs for one task/subtask/hemisphere/group unit
+def run_unit(unit):
+    task, subtask, hemi = unit['task'], unit['subtask'], unit['hemi']
+    onset, offset = unit['onset'], unit['offset']
+    subject_list, run_list = unit['subjects'], unit['runs']
+    scan_list = unit['scans']
+
+    # Print group-specific ISC notification
+    if unit['group']:
+        print(f"Computing within-group ISCs for {task} "
+              f"({hemi}): {unit['group']}")
+
+    # Compute ISCs (optionally streaming over scans)
+    print(f"Started ISC analysis for {subtask} ({hemi})")
+    load = partial(load_data, task=task, hemi=hemi,
+                   onset=onset, offset=offset)
+    data = None
+    if incremental:
+        stats_fn = unit_fn(unit, 'desc-isc_stats.npz')
+        params = {'onset': onset, 'offset': offset,
+                  'initial_trim': initial_trim, 'use_store': use_store,
+                  'fused': fused, 'polort': polort,
+                  'dtype': np.dtype(dtype).str}
+        iscs = incremental_isc(stats_fn, scan_list, load, params,
+                               zscored=True, dtype=dtype)
+        if iscs is None:
+            print(f"No changes to {unit['label']}; skipping ISC update")
+            return unit['label']
+    elif max_mem:
+        iscs = chunked_isc(scan_list, load, n_vertices,
+                           offset - onset - initial_trim,
+                           max_mem, zscored=True,
+                           streaming=streaming, dtype=dtype)
+    elif streaming:
+        iscs = streaming_isc(scan_list, load, zscored=True, dtype=dtype)
+    else:
+        data = np.dstack([load(scan) for scan in scan_list])
+        iscs = isc(data, zscored=True, dtype=dtype)
+    print(f"Finished ISC analysis for {subtask} ({hemi})")
+
+    # Split ISCs into subject-/run-specific GIfTI files
+    assert len(subject_list) == len(run_list) == len(iscs)
+    for s, fn, r in zip(subject_list, run_list, iscs):
+        isc_fn = join(afni_dir, s, 'func',
+                      fn.replace(f'_{scan_suffix}',
+                                 '_isc.gii').replace(
+                      f'task-{task}', f'task-{subtask}'))
+        template_fn = join(afni_dir, s, 'func', fn)
+        write_gifti(r, isc_fn, template_fn)
+        print(f"Saved {subtask} {s} ({hemi}) ISC")
+
+    # Optionally test the group-mean ISC against surrogate data
+    if n_surrogates:
+        if data is None:
+            data = np.dstack([load(scan) for scan in scan_list])
+        mean_isc, p_values = surrogate_isc(
+            data, n_surrogates=n_surrogates, method=surrogate_method,
+            zscored=True, dtype=dtype, n_workers=surrogate_workers,
+            max_mem=max_mem)
+        significant = fdr_threshold(p_values, q=fdr_q)
+
+        group_fn = unit_fn(unit, 'desc-pvalue_isc.gii')
+        write_gifti(p_values, group_fn, template_fn)
+        write_gifti(np.where(significant, mean_isc, 0),
+                    group_fn.replace('desc-pvalue', 'desc-fdr'),
+                    template_fn)
+        print(f"Saved surrogate p-values for {unit['label']} "
+              f"({np.sum(significant)} vertices at FDR q < {fdr_q})")
+
+    # Optionally compute sliding-window ISCs and a group time course
+    if dynamic_width:
+        if data is None:
+            data = np.dstack([load(scan) for scan in scan_list])
+        dynamic_iscs = dynamic_isc(data, dynamic_width, step=dynamic_step,
+                                   zscored=True, dtype=dtype)
+        dynamic_mean = FisherMean()
+        for s, fn, r in zip(subject_list, run_list, dynamic_iscs):
+            dynamic_fn = join(afni_dir, s, 'func',
+                              fn.replace(f'_{scan_suffix}',
+                                         '_desc-dynamic_isc.gii').replace(
+                              f'task-{task}', f'task-{subtask}'))
+            write_gifti(r, dynamic_fn, join(afni_dir, s, 'func', fn))
+            dynamic_mean.add(r)
+        write_gifti(dynamic_mean.mean().astype(dtype),
+                    unit_fn(unit, 'desc-dynamic_isc.gii'), template_fn)
+        print(f"Saved dynamic ISCs for {unit['label']} "
+              f"({dynamic_iscs.shape[1]} windows)")
+
+    return unit['label']
+
+
+# Run units in a process pool without exceeding the total memory budget
+def run_parallel(units, n_workers, total_mem):
+    total_mem = parse_memory(total_mem)
+
+    # Start with the largest units so small ones fill in the gaps
+    pending = sorted(units, key=unit_memory, reverse=True)
+    running, results = {}, []
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=get_context('fork')) as pool:
+        while pending or running:
+
+            # Submit units while workers and memory are available
+            for unit in list(pending):
+                if len(running) >= n_workers:
+                    break
+                used = sum(running.values())
+                if running and used + unit_memory(unit) > total_mem:
+                    continue
+                running[pool.submit(run_unit, unit)] = unit_memory(unit)
+                pending.remove(unit)
+
+            # Wait for at least one unit to finish
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                results.append(future.result())
+                print(f"Finished ISC unit {results[-1]} "
+                      f"({len(results)} of {len(units)})")
+
+    return results
+
+
+# Compile whole-brain ISC units (task x subtask x hemisphere x group)
+units = []
 for task in task_meta:
     
     # Skip 'schema' task for simplicity
@@ -72,89 +348,46 @@ for task in task_meta:
         onset = event_meta[task][subtask]['onset']
         offset = onset + event_meta[task][subtask]['duration']
 
-        # Get a convenience subject list for this task
-        subjects = sorted(task_meta[task].keys())
-
         # Loop through hemispheres
         for hemi in ['L', 'R']:
             
             # Loop through potential group manipulations (milkyway, paranoia)
             for group in groups:
                 
-                # Create lists for storing subjects and run filenames
-                subject_list, run_list = [], []
-                data = []
-                for subject in subjects:
-
-                    # Skip the subjects not belonging to this group
-                    if group and group != task_meta[subtask][
-                                              subject]['condition']:
-                        continue
-                    
-                    data_dir = join(afni_dir, subject, 'func')
-
-                    bold_fns = natsorted(glob(join(data_dir,
-                                  (f'{subject}_task-{task}_*space-{space}_'
-                                   f'hemi-{hemi}_desc-clean.func.gii'))))
-
-                    # Grab all runs in case of multiple runs
-                    for bold_fn in bold_fns:
-
-                        if exclude and exclude_scan(bold_fn, scan_exclude):
-                            print(f"Excluding {basename(bold_fn)}!")
-                            continue
-
-                        else:
-
-                            # Strip comments and load in data as numpy array
-                            subj_data = read_gifti(bold_fn)
-
-                            # Trim data based on event onset and duration
-                            subj_data = subj_data[onset:offset, :]
-                            subj_data = subj_data[initial_trim:, :]
-
-                            # Z-score input time series
-                            subj_data = zscore(subj_data, axis=0)
-
-                            subject_list.append(subject)
-                            run_list.append(basename(bold_fn))
-                            data.append(subj_data)
-                            print(f"Loaded {subtask} {subject} "
-                                  f"({hemi}) for ISC analysis")
-
-                data = np.dstack(data)
-                
-                # Print group-specific ISC notification
-                if group:
-                    print(f"Computing within-group ISCs for {task} "
-                          f"({hemi}): {group}")
-
-                # Compute ISCs
-                print(f"Started ISC analysis for {subtask} ({hemi})")
-                iscs = isc(data)
-                print(f"Finished ISC analysis for {subtask} ({hemi})")
-
-                # Split ISCs into subject-/run-specific GIfTI files
-                assert len(subject_list) == len(run_list) == len(iscs)
-                for s, fn, r in zip(subject_list, run_list, iscs):
-                    isc_fn = join(afni_dir, s, 'func',
-                                  fn.replace('_desc-clean.func.gii',
-                                             '_isc.gii').replace(
-                                  f'task-{task}', f'task-{subtask}'))
-                    template_fn = join(afni_dir, s, 'func', fn)
-                    write_gifti(r, isc_fn, template_fn)
-                    print(f"Saved {subtask} {s} ({hemi}) ISC")
-
-
-# Custom mean estimator with Fisher z transformation for correlations
-def fisher_mean(correlation, axis=None):
-    return np.tanh(np.nanmean(np.arctanh(correlation), axis=axis))
-
-
-# Compute mean ISC maps per task
+                # Collect scans for this group (excluding bad scans)
+                if use_store:
+                    subject_list, run_list, scan_list = store_scans(
+                        task, hemi, group)
+                else:
+                    subject_list, run_list, scan_list = collect_scans(
+                        afni_dir, task, hemi, task_meta,
+                        scan_suffix, space=space,
+                        subtask=subtask, group=group,
+                        scan_exclude=scan_exclude if exclude else None)
+
+                units.append({'task': task, 'subtask': subtask,
+                              'hemi': hemi, 'group': group,
+                              'onset': onset, 'offset': offset,
+                              'subjects': subject_list, 'runs': run_list,
+                              'scans': scan_list,
+                              'label': (f"{subtask} ({hemi})" +
+                                        (f": {group}" if group else ''))})
+
+
+# Compute ISCs for all units, optionally across a process pool
+if n_workers > 1:
+    run_parallel(units, n_workers, total_mem)
+else:
+    for unit in units:
+        run_unit(unit)
+
+
+# Compute mean ISC maps per task (and globally) in one pass over files
+task_means = {}
 for hemi in ['L', 'R']:
 
-    global_isc = []
+    global_mean = FisherMean()
+    global_isc, global_subjects = [], []
     for task in task_meta:
 
         # Skip 'schema' task for simplicity
@@ -175,8 +408,10 @@ for hemi in ['L', 'R']:
             # Get a convenience subject list for this task
             subjects = sorted(task_meta[task].keys())
             
-            # Stack data across subjects per task
-            task_isc = []
+            # Accumulate Fisher z-values across subjects per task (only
+            # keeping every map if bootstrapping)
+            task_mean = FisherMean()
+            task_isc, task_subjects = [], []
             for subject in subjects:
 
                 data_dir = join(afni_dir, subject, 'func')
@@ -193,41 +428,70 @@ for hemi in ['L', 'R']:
                         continue
 
                     else:
-                        subj_isc = read_gifti(isc_fn)
-                        task_isc.append(subj_isc)
-                        global_isc.append(subj_isc)
+                        subj_isc = read_gifti(isc_fn)[0, :]
+                        task_mean.add(subj_isc)
+                        global_mean.add(subj_isc)
+                        template_fn = isc_fn
+                        if n_bootstraps:
+                            task_isc.append(subj_isc)
+                            global_isc.append(subj_isc)
+                            task_subjects.append(subject)
+                            global_subjects.append(subject)
                         print(f"Loaded ISC map for {task} {subject}")
 
             # Fisher Z-transformed mean across subjects
-            task_mean = fisher_mean(task_isc, axis=0)[0, :]
+            task_means[(subtask, hemi)] = task_mean.mean()
             
             # Save mean ISC map
             task_fn = join(afni_dir, f'group_task-{subtask}_space-{space}_'
                                      f'hemi-{hemi}_desc-mean_isc.gii')
-            write_gifti(task_mean, task_fn, isc_fns[0])
+            write_gifti(task_means[(subtask, hemi)], task_fn, template_fn)
             print(f"Computed mean ISC for {subtask} ({hemi})")
+
+            # Optionally save bootstrap confidence intervals
+            if n_bootstraps:
+                lower, upper = bootstrap_fisher_mean(
+                    np.vstack(task_isc), task_subjects,
+                    n_bootstraps=n_bootstraps, ci=ci)
+                write_gifti(lower, task_fn.replace('desc-mean',
+                                                   'desc-lowerci'),
+                            template_fn)
+                write_gifti(upper, task_fn.replace('desc-mean',
+                                                   'desc-upperci'),
+                            template_fn)
+                print(f"Computed {ci}% bootstrap CI for {subtask} ({hemi})")
             
     # Get the global mean across all subjects and tasks
-    print(f"Computing global mean ISC across {len(global_isc)} subjects")
-    global_mean = fisher_mean(global_isc, axis=0)[0, :]
+    print(f"Computing global mean ISC across {global_mean.n_maps} "
+          "subjects")
     
     # Save mean ISC map
     global_fn = join(afni_dir, f'group_space-{space}_'
                                f'hemi-{hemi}_desc-mean_isc.gii')
-    write_gifti(global_mean, global_fn, isc_fns[0])
+    write_gifti(global_mean.mean(), global_fn, template_fn)
     print(f"Computed global mean ISC ({hemi})")
 
+    # Optionally save bootstrap confidence intervals (resampling subjects
+    # across all tasks they participated in)
+    if n_bootstraps:
+        lower, upper = bootstrap_fisher_mean(
+            np.vstack(global_isc), global_subjects,
+            n_bootstraps=n_bootstraps, ci=ci)
+        write_gifti(lower, global_fn.replace('desc-mean', 'desc-lowerci'),
+                    template_fn)
+        write_gifti(upper, global_fn.replace('desc-mean', 'desc-upperci'),
+                    template_fn)
+        print(f"Computed {ci}% bootstrap CI for global mean ({hemi})")
+
 
-# Combine 'slumlord' and 'reach' means
+# Combine 'slumlord' and 'reach' means (already in memory)
 for hemi in ['L', 'R']:    
     slumlord_fn = join(afni_dir, f'group_task-slumlord_space-{space}_'
                                  f'hemi-{hemi}_desc-mean_isc.gii')
-    reach_fn = join(afni_dir, f'group_task-reach_space-{space}_'
-                              f'hemi-{hemi}_desc-mean_isc.gii')
     
     # Compute mean of 'slumlord' and 'reach' means
-    comb_isc = fisher_mean((read_gifti(slumlord_fn),
-                            read_gifti(reach_fn)), axis=0)[0, :]
+    comb_isc = FisherMean().add(task_means[('slumlord', hemi)]).add(
+        task_means[('reach', hemi)]).mean()
     
     # Save combined map
     comb_fn = join(afni_dir, f'group_task-slumlordreach_space-{space}_'
@@ -0,0 +1,128 @@
+from os.path import basename, join
+from functools import partial
+import json
+import numpy as np
+from isc_engine import chunked_lagged_isc
+from exclude_scans import ExclusionIndex
+from gifti_io import write_gifti
+from load_timeseries import collect_scans, load_trimmed
+
+space = 'fsaverage6'
+afni_pipe = 'afni-smooth'
+initial_trim = 6
+lags = 30
+circular = True
+
+# Precision for loading, z-scoring and lagged ISC
+dtype = np.float32
+
+# Lagged ISC is computed in vertex blocks sized to this memory budget
+max_mem = '8GB'
+n_vertices = 40962
+
+base_dir = '/jukebox/hasson/snastase/narratives'
+deriv_dir = join(base_dir, 'derivatives')
+afni_dir = join(base_dir, 'derivatives', afni_pipe)
+
+
+# Get metadata for all subjects for a given task
+with open(join(base_dir, 'code', 'task_meta.json')) as f:
+    task_meta = json.load(f)
+
+
+# Get event onsets and durations for each task
+with open(join(base_dir, 'code', 'event_meta.json')) as f:
+    event_meta = json.load(f)
+
+
+# Load scans to exclude
+exclude = True
+with open(join(base_dir, 'code', 'scan_exclude.json')) as f:
+    scan_exclude = ExclusionIndex(json.load(f))
+
+
+# Skip 'notthefall' scramble and 'schema' tasks for simplicity
+skip_tasks = ['notthefalllongscram', 'notthefallshortscram',
+              'schema']
+
+
+# Load, trim and z-score a block of vertices for a single scan
+def load_data(scan, onset, offset, vertices=slice(None)):
+    subj_data = load_trimmed(scan, onset, offset,
+                             initial_trim=initial_trim, dtype=dtype,
+                             vertices=vertices)
+    print(f"Loaded {basename(scan)} for lagged ISC analysis")
+    return subj_data
+
+
+# Compute whole-brain peak-lag and peak-ISC maps for each scan
+for task in task_meta:
+
+    # Skip 'schema' task for simplicity
+    if task in skip_tasks:
+        print(f"Skipping {task} for whole-brain lagged ISC analysis")
+        continue
+
+    # Split off 'slumlordreach' stories
+    if task == 'slumlordreach':
+        subtasks = ['slumlord', 'reach']
+
+    else:
+        subtasks = [task]
+
+    # Loop through potential substories (i.e. for 'slumlordreach')
+    for subtask in subtasks:
+
+        # Split milkyway and prettymouth by condition/group
+        if task == 'milkyway':
+            groups = ['original', 'vodka', 'synonyms']
+        elif task == 'prettymouth':
+            groups = ['affair', 'paranoia']
+        else:
+            groups = [None]
+
+        # Grab event onsets and offsets for trimming
+        onset = event_meta[task][subtask]['onset']
+        offset = onset + event_meta[task][subtask]['duration']
+
+        # Loop through hemispheres
+        for hemi in ['L', 'R']:
+
+            # Loop through potential group manipulations (milkyway, paranoia)
+            for group in groups:
+
+                # Collect scans for this group (excluding bad scans)
+                subject_list, run_list, scan_list = collect_scans(
+                    afni_dir, task, hemi, task_meta,
+                    'desc-clean.func.gii', space=space,
+                    subtask=subtask, group=group,
+                    scan_exclude=scan_exclude if exclude else None)
+
+                # Print group-specific ISC notification
+                if group:
+                    print(f"Computing within-group lagged ISCs for {task} "
+                          f"({hemi}): {group}")
+
+                # Compute peak lags and peak ISCs in vertex blocks
+                load = partial(load_data, onset=onset, offset=offset)
+                peak_lags, peak_iscs = chunked_lagged_isc(
+                    scan_list, load, n_vertices,
+                    offset - onset - initial_trim, max_mem, lags=lags,
+                    circular=circular, zscored=True, dtype=dtype)
+                print(f"Finished lagged ISC analysis for {subtask} ({hemi})")
+
+                # Split maps into subject-/run-specific GIfTI files
+                assert (len(subject_list) == len(run_list) ==
+                        len(peak_lags) == len(peak_iscs))
+                for s, fn, p, r in zip(subject_list, run_list,
+                                       peak_lags, peak_iscs):
+                    template_fn = join(afni_dir, s, 'func', fn)
+                    lag_fn = join(afni_dir, s, 'func',
+                                  fn.replace('_desc-clean.func.gii',
+                                             '_desc-peaklag_isc.gii').replace(
+                                  f'task-{task}', f'task-{subtask}'))
+                    write_gifti(p.astype(np.float32), lag_fn, template_fn)
+                    write_gifti(r, lag_fn.replace('desc-peaklag',
+                                                  'desc-peak'),
+                                template_fn)
+                    print(f"Saved {subtask} {s} ({hemi}) peak lag and ISC")
@@ -4,22 +4,34 @@ from sys import argv
 from os.path import basename, exists, join
 from os import chdir
 import json
+from glob import glob
 from subprocess import run
+from natsort import natsorted
+from confound_regression import clean_run
 
 
-# Pull in variables (from Slurm submission)
+# Pull in variables (from Slurm submission); several spaces can be
+# given separated by commas (e.g. fsaverage6,MNI152NLin2009cAsym) so
+# that each run's confound model is factorized once for all of them
 subject = f'sub-{argv[1]}'
-space = argv[2]
+spaces = argv[2].split(',')
 afni_pipe = argv[3]
 
 # Smoothing kernel width for smoothed data
 if afni_pipe == 'afni-smooth':
     smoothness = 'sm6'
 
+# Regress confounds in NumPy (or set True to shell out to 3dTproject)
+use_afni = False
+
+# Also clean ROI average time series (see roi_average.py) for each run
+batch_rois = afni_pipe == 'afni-nosmooth'
+
 # Check that we get a reasonable space
-if 'MNI' not in space and 'fsaverage' not in space:
-    raise AssertionError("Expected either MNI or fsaverage space")
-    
+for space in spaces:
+    if 'MNI' not in space and 'fsaverage' not in space:
+        raise AssertionError("Expected either MNI or fsaverage space")
+
 # Assign some directories
 base_dir = '/jukebox/hasson/snastase/narratives'
 deriv_dir = join(base_dir, 'derivatives')
@@ -35,51 +47,80 @@ with open(join(base_dir, 'code', 'subject_meta.json')) as f:
     subject_meta = json.load(f)
 
 
-# Grab input BOLD filenames from metadata
-if afni_pipe == 'afni-smooth':
-    bold_fns = subject_meta[subject]['bold'][space][smoothness]
+# Collect data targets (input, output and mask) for each run
+run_targets = {}
+for space in spaces:
+
+    # Grab input BOLD filenames from metadata
+    if afni_pipe == 'afni-smooth':
+        bold_fns = subject_meta[subject]['bold'][space][smoothness]
+
+    elif afni_pipe == 'afni-nosmooth':
+        bold_fns = subject_meta[subject]['bold'][space]['preproc']
+
+    # Loop through BOLD filenames (tasks and runs)
+    for bold_fn in bold_fns:
 
-elif afni_pipe == 'afni-nosmooth':
-    bold_fns = subject_meta[subject]['bold'][space]['preproc']
+        # Get output clean BOLD filename
+        if afni_pipe == 'afni-smooth':
+            clean_fn = join(afni_dir,
+                            basename(bold_fn).replace(f'desc-{smoothness}',
+                                                      'desc-clean'))
+        elif afni_pipe == 'afni-nosmooth' and 'fsaverage' not in space:
+            clean_fn = join(afni_dir,
+                            basename(bold_fn).replace('desc-preproc',
+                                                      'desc-clean'))
+        elif afni_pipe == 'afni-nosmooth' and 'fsaverage' in space:
+            clean_fn = join(afni_dir,
+                            basename(bold_fn).replace('.func.gii',
+                                                      '_desc-clean.func.gii'))
 
+        # Get the volumetric mask resampled for this task if necessary
+        mask_fn = None
+        if 'fsaverage' not in space:
+            task = basename(bold_fn).split('task-')[-1].split('_')[0]
+            mask_fn = join(deriv_dir, afni_pipe, f'tpl-{space}',
+                           f'tpl-{space}_res-{task}_desc-brain_mask.nii.gz')
+            assert exists(mask_fn)
+
+        run_name = basename(bold_fn).split('_space')[0]
+        run_targets.setdefault(run_name, []).append(
+            (bold_fn, clean_fn, mask_fn))
+
+
+# Add ROI average time series for each run
+if batch_rois:
+    for run_name in run_targets:
+        roi_fns = natsorted(glob(join(
+            afni_dir, f'{run_name}_space-*_roi-*_desc-mean_timeseries.1D')))
+        for roi_fn in roi_fns:
+            run_targets[run_name].append(
+                (roi_fn, roi_fn.replace('desc-mean', 'desc-clean'), None))
+
+
+# Loop through runs and clean all of their data targets
+for run_name, targets in run_targets.items():
 
-# Loop through BOLD filenames (tasks and runs)
-for bold_fn in bold_fns:
-    
     # Get corresponding model regressors filename
-    model_fn = join(afni_dir, (basename(bold_fn).split('_space')[0] + 
-                              '_desc-model_regressors.1D'))
+    model_fn = join(afni_dir, f'{run_name}_desc-model_regressors.1D')
     assert exists(model_fn)
-    
-    # Get output clean BOLD filename
-    if afni_pipe == 'afni-smooth':
-        clean_fn = join(afni_dir,
-                        basename(bold_fn).replace(f'desc-{smoothness}',
-                                                  'desc-clean'))
-    elif afni_pipe == 'afni-nosmooth' and 'fsaverage' not in space:
-        clean_fn = join(afni_dir,
-                        basename(bold_fn).replace(f'desc-preproc',
-                                                  'desc-clean'))
-    elif afni_pipe == 'afni-nosmooth' and 'fsaverage' in space:
-        clean_fn = join(afni_dir,
-                        basename(bold_fn).replace(f'.func.gii',
-                                                  '_desc-clean.func.gii'))
-    
-    # Get the volumetric mask resampled for this task if necessary
-    if 'fsaverage' not in space:
-        task = basename(bold_fn).split('task-')[-1].split('_')[0]
-        mask_fn = join(deriv_dir, afni_pipe, f'tpl-{space}',
-                       f'tpl-{space}_res-{task}_desc-brain_mask.nii.gz')
-        assert exists(mask_fn)
-    
 
     # Perform confound regression via AFNI's 3dTproject
-    if 'fsaverage' in space:
-        run(f"3dTproject -input {bold_fn} -ort {model_fn} -TR 1.5 "
-            f"-prefix {clean_fn} -polort 2 -overwrite", shell=True)
+    if use_afni:
+        for bold_fn, clean_fn, mask_fn in targets:
+            if mask_fn:
+                run(f"3dTproject -input {bold_fn} -ort {model_fn} "
+                    f"-overwrite -prefix {clean_fn} -mask {mask_fn} "
+                    "-polort 2", shell=True)
+            else:
+                run(f"3dTproject -input {bold_fn} -ort {model_fn} -TR 1.5 "
+                    f"-prefix {clean_fn} -polort 2 -overwrite", shell=True)
+
+    # Or factorize the confound model (and polort 2 trends) once and
+    # project it out of every target for this run
     else:
-        run(f"3dTproject -input {bold_fn} -ort {model_fn} -overwrite "
-            f"-prefix {clean_fn} -mask {mask_fn} -polort 2", shell=True)
+        clean_run(targets, model_fn, polort=2)
 
-    print(f"Finished model confound regression(s) for {subject}:"
-          f"\n  {basename(clean_fn)}")
+    for _, clean_fn, _ in targets:
+        print(f"Finished model confound regression(s) for {subject}:"
+              f"\n  {basename(clean_fn)}")
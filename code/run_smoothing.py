@@ -5,6 +5,8 @@ from os.path import basename, exists, join
 from os import makedirs, remove
 import json
 from subprocess import run
+from gifti_io import read_gifti, write_gifti
+from surface_smoothing import cached_operator, load_mask, smooth_surface
 
 
 # Pull in variables (from Slurm submission)
@@ -12,6 +14,12 @@ subject = f'sub-{argv[1]}'
 space = argv[2]
 width = argv[3]
 
+# Smooth surface data via SurfSmooth (blurring *to* the target FWHM), or
+# set False to apply the sparse heat kernel in Python (blurring *by* the
+# FWHM); both write desc-sm{width}, so only switch when regenerating all
+# smoothed outputs
+use_afni = True
+
 
 # Check that we get a reasonable space
 if 'MNI' not in space and 'fsaverage' not in space:
@@ -36,6 +44,11 @@ if 'fsaverage' in space:
     surf_fns = {'L': join(surf_dir, 'lh.pial'),
                 'R': join(surf_dir, 'rh.pial')}
 
+    # Heat kernel smoothing operators (built once per hemisphere and
+    # cached on disk, shared across subjects for this mesh, mask and FWHM)
+    operators, masks = {}, {}
+    operator_dir = join(deriv_dir, afni_pipe, f'tpl-{space}', 'operators')
+
 
 # Load subject metadata to get filenames
 with open(join(base_dir, 'code', 'subject_meta.json')) as f:
@@ -67,14 +80,29 @@ for bold_fn in bold_fns:
         mask_fn = join(deriv_dir, afni_pipe, f'tpl-{space}',
                        f'tpl-{space}_hemi-{hemi}_desc-cortex_mask.1D')
         
-        if task in ['schema', 'shapesphysical', 'shapessocial']:
-            sigma = .6
-        elif task in ['black', 'forgot', 'bronx', 'piemanpni']:
-            sigma = .55
+        # Iterative heat kernel smoothing via AFNI's SurfSmooth
+        if use_afni:
+            if task in ['schema', 'shapesphysical', 'shapessocial']:
+                sigma = .6
+            elif task in ['black', 'forgot', 'bronx', 'piemanpni']:
+                sigma = .55
+            else:
+                sigma = .48
+
+            run(f"SurfSmooth -input {bold_fn} -target_fwhm {width} "
+                f"-i_fs {surf_fns[hemi]} -output {smooth_fn} "
+                f"-blurmaster {bold_fn} -detrend_master "
+                f"-b_mask {mask_fn} -met HEAT_07 -bmall -sigma {sigma} "
+                "-overwrite", shell=True)
+
+        # Or apply the pial-mesh heat kernel for this FWHM within the
+        # cortex mask (one sparse-dense product for all TRs)
         else:
-            sigma = .48
-
-        run(f"SurfSmooth -input {bold_fn} -target_fwhm {width} "
-            f"-i_fs {surf_fns[hemi]} -output {smooth_fn} "
-            f"-blurmaster {bold_fn} -detrend_master -b_mask {mask_fn} "
-            f"-met HEAT_07 -bmall -sigma {sigma} -overwrite", shell=True)
+            if hemi not in operators:
+                masks[hemi] = load_mask(mask_fn)
+                operators[hemi] = cached_operator(
+                    surf_fns[hemi], float(width), mask=masks[hemi],
+                    cache_dir=operator_dir)
+            smoothed = smooth_surface(read_gifti(bold_fn), operators[hemi],
+                                      mask=masks[hemi])
+            write_gifti(smoothed, smooth_fn, bold_fn, split_rows=True)
@@ -45,6 +45,7 @@ echo "Running spatial smoothing on sub-$subj"
 #./run_regression.py $subj fsaverage6 afni-nosmooth
 #./run_regression.py $subj MNI152NLin2009cAsym afni-smooth
 #./run_regression.py $subj MNI152NLin2009cAsym afni-nosmooth
+#./run_regression.py $subj fsaverage6,MNI152NLin2009cAsym afni-nosmooth
 
 echo "Finished spatially smoothing sub-$subj"
 date
@@ -0,0 +1,288 @@
+from os import getpid, makedirs, replace
+from os.path import basename, exists, join
+import hashlib
+import numpy as np
+from scipy import sparse
+import nibabel as nib
+from afni_io import load_1D_matrix
+from gifti_io import read_gifti
+
+
+# Function to get unique mesh edges and their lengths
+def mesh_edges(coords, faces):
+    """Unique edges of a triangular mesh and their Euclidean lengths
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        Vertex coordinates (vertices x 3)
+    faces : np.ndarray
+        Vertex indices of each triangle (faces x 3)
+
+    Returns
+    -------
+    edges : np.ndarray
+        Vertex indices of each edge (edges x 2)
+    lengths : np.ndarray
+        Length of each edge
+
+    """
+    edges = np.vstack((faces[:, [0, 1]], faces[:, [1, 2]],
+                       faces[:, [2, 0]]))
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    lengths = np.linalg.norm(coords[edges[:, 0]] - coords[edges[:, 1]],
+                             axis=1)
+    return edges, lengths
+
+
+# Function to load a cortex mask (see brain_masks.py) as booleans
+def load_mask(mask_fn):
+    """Load a cortex mask from GIfTI (.gii) or one-value-per-line 1D file
+
+    Parameters
+    ----------
+    mask_fn : str
+        Mask filename (e.g. tpl-fsaverage6_hemi-L_desc-cortex_mask.1D)
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of vertices to smooth
+
+    """
+    if mask_fn.endswith('.gii'):
+        return read_gifti(mask_fn)[0] > 0
+    return load_1D_matrix(mask_fn)[:, 0] > 0
+
+
+# Function for one row-normalized heat kernel step over 1-ring neighbors
+def heat_kernel_step(edges, lengths, n_vertices, sigma):
+    """Gaussian-weighted average of each vertex and its 1-ring neighbors
+
+    Parameters
+    ----------
+    edges : np.ndarray
+        Vertex indices of each edge (edges x 2)
+    lengths : np.ndarray
+        Length of each edge
+    n_vertices : int
+        Number of vertices
+    sigma : float
+        Bandwidth of Gaussian weights (in units of the coordinates)
+
+    Returns
+    -------
+    sparse.csr_matrix
+        Row-stochastic step matrix (vertices x vertices)
+
+    """
+    weights = np.exp(-lengths ** 2 / (2 * sigma ** 2))
+    step = sparse.coo_matrix(
+        (np.concatenate((weights, weights, np.ones(n_vertices))),
+         (np.concatenate((edges[:, 0], edges[:, 1],
+                          np.arange(n_vertices))),
+          np.concatenate((edges[:, 1], edges[:, 0],
+                          np.arange(n_vertices))))),
+        shape=(n_vertices, n_vertices)).tocsr()
+    return sparse.diags(1 / np.asarray(step.sum(axis=1)).ravel()) @ step
+
+
+# Function to precompute the heat kernel smoothing operator for a FWHM
+def smoothing_operator(surf_fn, fwhm, mask=None, tolerance=1e-6,
+                       dtype=np.float32):
+    """Sparse heat kernel smoothing operator for a surface mesh
+
+    Heat kernel smoothing (as in SurfSmooth -met HEAT_07) iterates a
+    Gaussian-weighted average over each vertex's 1-ring neighbors; the
+    variance added by each step is the mean squared step length, so
+    the number of steps (and the weight left on each vertex itself) is
+    chosen for the variance of the requested FWHM. The iterated steps
+    are multiplied into a single sparse operator, so smoothing a scan
+    is one sparse-dense product. Vertices outside the mask (e.g. the
+    medial wall) neither contribute to nor receive smoothing.
+
+    Parameters
+    ----------
+    surf_fn : str
+        FreeSurfer surface (e.g. freesurfer/fsaverage6/surf/lh.pial)
+    fwhm : float
+        Full width at half maximum of the smoothing kernel (in mm)
+    mask : np.ndarray, optional
+        Boolean mask of vertices to smooth (see load_mask)
+    tolerance : float, default: 1e-6
+        Drop operator weights below this value (rows are renormalized)
+    dtype : np.dtype, default: np.float32
+        Precision of the operator
+
+    Returns
+    -------
+    sparse.csr_matrix
+        Smoothing operator (masked vertices x masked vertices)
+
+    """
+    coords, faces = nib.freesurfer.read_geometry(surf_fn)
+    if mask is None:
+        mask = np.ones(len(coords), dtype=bool)
+
+    # Keep only edges within the mask, indexed among masked vertices
+    edges, lengths = mesh_edges(coords, faces)
+    within = np.all(mask[edges], axis=1)
+    index = np.cumsum(mask) - 1
+    edges, lengths = index[edges[within]], lengths[within]
+    n_vertices = np.sum(mask)
+
+    # Variance per step (per axis on the surface) from Gaussian weights
+    # with bandwidth of the mean edge length
+    step = heat_kernel_step(edges, lengths, n_vertices, np.mean(lengths))
+    rows = np.repeat(np.arange(n_vertices), np.diff(step.indptr))
+    coords = coords[mask]
+    squared = np.sum((coords[rows] - coords[step.indices]) ** 2, axis=1)
+    step_variance = np.sum(step.data * squared) / n_vertices / 2
+
+    # Number of steps and laziness (weight kept on each vertex) to
+    # reach the variance of the requested FWHM
+    variance = (fwhm / np.sqrt(8 * np.log(2))) ** 2
+    n_steps = int(np.ceil(variance / step_variance))
+    laziness = 1 - variance / (n_steps * step_variance)
+    step = (laziness * sparse.identity(n_vertices, format='csr') +
+            (1 - laziness) * step)
+
+    operator = step
+    for _ in np.arange(n_steps - 1):
+        operator = operator @ step
+        operator.data[operator.data < tolerance] = 0
+        operator.eliminate_zeros()
+    operator = sparse.diags(1 / np.asarray(
+        operator.sum(axis=1)).ravel()) @ operator
+
+    return operator.astype(dtype).tocsr()
+
+
+# Function to load (or build and save) a smoothing operator via disk cache
+def cached_operator(surf_fn, fwhm, mask=None, cache_dir=None,
+                    tolerance=1e-6, dtype=np.float32):
+    """Smoothing operator shared across scans and subjects via disk cache
+
+    Every subject in fsaverage6 shares the same mesh, so the operator
+    for a given surface, mask and FWHM is built once and saved as .npy
+    files (CSR data, indices and indptr) keyed by a hash of the surface
+    file, the mask, FWHM, tolerance and dtype. Cached operators are
+    loaded memory-mapped (read-only), so worker processes smoothing
+    different subjects share one copy in the page cache.
+
+    Parameters
+    ----------
+    surf_fn : str
+        FreeSurfer surface (e.g. freesurfer/fsaverage6/surf/lh.pial)
+    fwhm : float
+        Full width at half maximum of the smoothing kernel (in mm)
+    mask : np.ndarray, optional
+        Boolean mask of vertices to smooth (see load_mask)
+    cache_dir : str, optional
+        Directory for cached operators; None builds without caching
+    tolerance : float, default: 1e-6
+        Drop operator weights below this value (see smoothing_operator)
+    dtype : np.dtype, default: np.float32
+        Precision of the operator
+
+    Returns
+    -------
+    sparse.csr_matrix
+        Smoothing operator (masked vertices x masked vertices)
+
+    """
+    if cache_dir is None:
+        return smoothing_operator(surf_fn, fwhm, mask=mask,
+                                  tolerance=tolerance, dtype=dtype)
+
+    # Key on surface contents (including hemisphere), mask and parameters
+    with open(surf_fn, 'rb') as f:
+        key = hashlib.sha1(f.read())
+    if mask is not None:
+        key.update(np.asarray(mask, dtype=bool).tobytes())
+    key.update(f'{float(fwhm)}:{tolerance}:{np.dtype(dtype).str}'.encode())
+    prefix = join(cache_dir, (f'{basename(surf_fn)}_fwhm-{float(fwhm):g}_'
+                              f'{key.hexdigest()}'))
+
+    # Build and save operator if not cached (indptr is written last, so
+    # readers never see a partial operator)
+    if not exists(f'{prefix}_indptr.npy'):
+        operator = smoothing_operator(surf_fn, fwhm, mask=mask,
+                                      tolerance=tolerance, dtype=dtype)
+        makedirs(cache_dir, exist_ok=True)
+        for name in ['data', 'indices', 'indptr']:
+            tmp_fn = f'{prefix}_{name}.{getpid()}.tmp.npy'
+            np.save(tmp_fn, getattr(operator, name))
+            replace(tmp_fn, f'{prefix}_{name}.npy')
+        print(f"Saved smoothing operator {basename(prefix)}")
+
+    data, indices, indptr = [np.load(f'{prefix}_{name}.npy', mmap_mode='r')
+                             for name in ['data', 'indices', 'indptr']]
+    n_vertices = len(indptr) - 1
+    return sparse.csr_matrix((data, indices, indptr),
+                             shape=(n_vertices, n_vertices), copy=False)
+
+
+# Function to smooth all TRs of a scan with a precomputed operator
+def smooth_surface(data, operator, mask=None):
+    """Apply a smoothing operator to (TRs x vertices) surface data
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Surface time series (TRs x vertices)
+    operator : sparse.csr_matrix
+        Operator returned by smoothing_operator
+    mask : np.ndarray, optional
+        Boolean mask used to build the operator; vertices outside the
+        mask are returned unchanged
+
+    Returns
+    -------
+    np.ndarray
+        Smoothed time series (TRs x vertices)
+
+    """
+    data = np.asarray(data, dtype=operator.dtype)
+    if mask is None:
+        return (operator @ data.T).T
+    smoothed = data.copy()
+    smoothed[:, mask] = (operator @ data[:, mask].T).T
+    return smoothed
+
+
+# Name guard for validating the operator FWHM on a flat mesh
+if __name__ == '__main__':
+    from tempfile import TemporaryDirectory
+
+    # Triangulated 1 mm grid (in the xy-plane) saved as a surface
+    n_side = 101
+    x, y = np.meshgrid(np.arange(n_side), np.arange(n_side))
+    coords = np.column_stack((x.ravel(), y.ravel(),
+                              np.zeros(n_side ** 2))).astype(float)
+    corners = (np.arange(n_side - 1)[:, np.newaxis] * n_side +
+               np.arange(n_side - 1)).ravel()
+    faces = np.vstack((np.column_stack((corners, corners + 1,
+                                        corners + n_side)),
+                       np.column_stack((corners + 1, corners + n_side + 1,
+                                        corners + n_side))))
+
+    with TemporaryDirectory() as temp_dir:
+        surf_fn = join(temp_dir, 'lh.flat')
+        nib.freesurfer.write_geometry(surf_fn, coords, faces)
+
+        # Smooth a single impulse at the center of the grid
+        fwhm = 6
+        operator = smoothing_operator(surf_fn, fwhm, dtype=np.float64)
+        impulse = np.zeros((1, n_side ** 2))
+        impulse[0, n_side ** 2 // 2] = 1
+        kernel = smooth_surface(impulse, operator)[0]
+
+    # FWHM from the kernel's variance (per axis) around its center
+    center = coords[n_side ** 2 // 2]
+    variance = np.sum(kernel * np.sum((coords - center) ** 2, axis=1)) / 2
+    estimate = np.sqrt(8 * np.log(2) * variance)
+    print(f"Requested FWHM = {fwhm} mm, kernel FWHM = {estimate:.2f} mm "
+          f"({operator.nnz / operator.shape[0]:.0f} weights per vertex)")
+    assert np.isclose(estimate, fwhm, rtol=.05)
+    assert np.allclose(operator.sum(axis=1), 1)
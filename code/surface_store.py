@@ -0,0 +1,250 @@
+from os.path import basename, getmtime, join
+import json
+from glob import glob
+import numpy as np
+import h5py
+from natsort import natsorted
+from exclude_scans import exclude_scan
+from gifti_io import read_gifti
+
+
+# Function to pack surface time series into a single HDF5 store
+def build_store(store_fn, data_dir, task_meta, event_meta,
+                space='fsaverage6', suffix='_desc-clean.func.gii',
+                skip_tasks=[], chunk_vertices=2048, compression=4):
+    """Pack surface time series for all scans into one chunked HDF5 file
+
+    Each scan is stored as a (TRs x vertices) dataset at
+    ``/{task}/{hemi}/{scan}`` (where scan is the BIDS stem, e.g.
+    ``sub-001_task-pieman_run-1``), chunked along vertices so that
+    vertex blocks can be read without decompressing the whole scan.
+    Subject, condition and source filename are stored as dataset
+    attributes, and event onsets/durations are stored per task.
+    Scans already in the store with an unchanged source file are
+    skipped, so the store can be updated incrementally.
+
+    Parameters
+    ----------
+    store_fn : str
+        Output HDF5 filename
+    data_dir : str
+        Derivatives directory containing sub-*/func/ (e.g. afni-smooth)
+    task_meta : dict
+        Task metadata (e.g. loaded from task_meta.json)
+    event_meta : dict
+        Event onsets and durations (e.g. loaded from event_meta.json)
+    space : str, default: 'fsaverage6'
+        Surface space of input files
+    suffix : str, default: '_desc-clean.func.gii'
+        Filename suffix following hemi-{hemi} of input files
+    skip_tasks : list, optional
+        Tasks to leave out of the store
+    chunk_vertices : int, default: 2048
+        Number of vertices per chunk
+    compression : int, default: 4
+        Gzip compression level
+
+    """
+    with h5py.File(store_fn, 'a') as store:
+        for task in task_meta:
+            if task in skip_tasks:
+                continue
+
+            task_group = store.require_group(task)
+            task_group.attrs['events'] = json.dumps(event_meta[task])
+
+            for hemi in ['L', 'R']:
+                hemi_group = task_group.require_group(hemi)
+
+                for subject in sorted(task_meta[task].keys()):
+                    bold_fns = natsorted(glob(join(
+                        data_dir, subject, 'func',
+                        (f'{subject}_task-{task}_*space-{space}_'
+                         f'hemi-{hemi}{suffix}'))))
+
+                    # Grab all runs in case of multiple runs
+                    for bold_fn in bold_fns:
+                        scan = basename(bold_fn).split('_space')[0]
+                        mtime = getmtime(bold_fn)
+
+                        # Skip scans that are already up to date
+                        if (scan in hemi_group and
+                            hemi_group[scan].attrs['mtime'] == mtime):
+                            continue
+                        elif scan in hemi_group:
+                            del hemi_group[scan]
+
+                        subj_data = read_gifti(bold_fn).astype(np.float32)
+                        chunks = (subj_data.shape[0],
+                                  min(chunk_vertices, subj_data.shape[1]))
+                        dset = hemi_group.create_dataset(
+                            scan, data=subj_data, chunks=chunks,
+                            compression='gzip',
+                            compression_opts=compression, shuffle=True)
+                        dset.attrs['subject'] = subject
+                        dset.attrs['condition'] = task_meta[task][
+                            subject]['condition']
+                        dset.attrs['source'] = basename(bold_fn)
+                        dset.attrs['mtime'] = mtime
+                        print(f"Stored {task} {subject} ({hemi})"
+                              f"\n  {scan}")
+
+
+# Convert vertex selection into something h5py can index with
+def _vertex_index(vertices):
+    if vertices is None:
+        return slice(None)
+    elif isinstance(vertices, slice):
+        return vertices
+    vertices = np.asarray(vertices)
+    if vertices.dtype == bool:
+        vertices = np.flatnonzero(vertices)
+    return np.sort(vertices)
+
+
+# Function to list scans (and their metadata) in the store
+def store_index(store_fn, task, hemi):
+    """List scans stored for a task and hemisphere
+
+    Parameters
+    ----------
+    store_fn : str
+        HDF5 store created by build_store
+    task : str
+        Task name (e.g. 'pieman')
+    hemi : str
+        Hemisphere ('L' or 'R')
+
+    Returns
+    -------
+    list of dict
+        One dict per scan with 'scan', 'subject', 'condition',
+        'source' and 'n_TRs'
+    events : dict
+        Event onsets and durations for each subtask
+
+    """
+    with h5py.File(store_fn, 'r') as store:
+        events = json.loads(store[task].attrs['events'])
+        index = [{'scan': scan,
+                  'subject': dset.attrs['subject'],
+                  'condition': dset.attrs['condition'],
+                  'source': dset.attrs['source'],
+                  'n_TRs': dset.shape[0]}
+                 for scan, dset in natsorted(store[task][hemi].items())]
+    return index, events
+
+
+# Function to read a single scan (or part of it) from the store
+def load_scan(store_fn, task, hemi, scan, rows=None, vertices=None):
+    """Read (TRs x vertices) data for one scan, optionally a block of it
+
+    Parameters
+    ----------
+    store_fn : str
+        HDF5 store created by build_store
+    task : str
+        Task name (e.g. 'pieman')
+    hemi : str
+        Hemisphere ('L' or 'R')
+    scan : str
+        BIDS stem of scan (e.g. 'sub-001_task-pieman_run-1')
+    rows : slice, optional
+        TRs to read
+    vertices : slice or array, optional
+        Vertex indices or boolean mask to read
+
+    Returns
+    -------
+    np.ndarray
+        Time series data (TRs x vertices)
+
+    """
+    rows = rows if rows is not None else slice(None)
+    with h5py.File(store_fn, 'r') as store:
+        return store[task][hemi][scan][rows, _vertex_index(vertices)]
+
+
+# Function to pull a (TRs x vertices x scans) block for a task
+def load_block(store_fn, task, hemi, subtask=None, group=None,
+               vertices=None, initial_trim=0, scan_exclude=None):
+    """Load trimmed time series for all scans of a task from the store
+
+    Parameters
+    ----------
+    store_fn : str
+        HDF5 store created by build_store
+    task : str
+        Task name (e.g. 'slumlordreach')
+    hemi : str
+        Hemisphere ('L' or 'R')
+    subtask : str, optional
+        Subtask for event trimming (e.g. 'slumlord'); defaults to task
+    group : str, optional
+        Only include scans with this condition (e.g. 'affair')
+    vertices : slice or array, optional
+        Vertex indices or boolean mask to read
+    initial_trim : int, default: 0
+        Number of TRs to drop after event onset
+    scan_exclude : dict, optional
+        Dictionary of scans to exclude (e.g. from scan_exclude.json)
+
+    Returns
+    -------
+    data : np.ndarray
+        Trimmed time series (TRs x vertices x scans)
+    subject_list : list
+        Subject for each scan
+    run_list : list
+        Source filename for each scan
+
+    """
+    subtask = subtask or task
+    index, events = store_index(store_fn, task, hemi)
+    onset = events[subtask]['onset']
+    offset = onset + events[subtask]['duration']
+    rows = slice(onset + initial_trim, offset)
+    vertex_index = _vertex_index(vertices)
+
+    subject_list, run_list, data = [], [], []
+    with h5py.File(store_fn, 'r') as store:
+        for scan in index:
+            if group and group != scan['condition']:
+                continue
+            if scan_exclude and exclude_scan(scan['source'], scan_exclude):
+                print(f"Excluding {scan['source']}!")
+                continue
+
+            data.append(store[task][hemi][scan['scan']][rows,
+                                                        vertex_index])
+            subject_list.append(scan['subject'])
+            run_list.append(scan['source'])
+
+    return np.dstack(data), subject_list, run_list
+
+
+# Name guard for building the store from the command line
+if __name__ == '__main__':
+
+    space = 'fsaverage6'
+
+    base_dir = '/jukebox/hasson/snastase/narratives'
+
+    with open(join(base_dir, 'code', 'task_meta.json')) as f:
+        task_meta = json.load(f)
+
+    with open(join(base_dir, 'code', 'event_meta.json')) as f:
+        event_meta = json.load(f)
+
+    # Build stores for smoothed (run_isc.py) and non-smoothed (roi_isc.py)
+    # cleaned data
+    for afni_pipe in ['afni-smooth', 'afni-nosmooth']:
+        afni_dir = join(base_dir, 'derivatives', afni_pipe)
+        store_fn = join(afni_dir, f'group_space-{space}_desc-clean_bold.h5')
+        build_store(store_fn, afni_dir, task_meta, event_meta, space=space)
+
+    # Build store of non-cleaned fMRIPrep outputs (roi_average.py)
+    store_fn = join(base_dir, 'derivatives', 'afni-nosmooth',
+                    f'group_space-{space}_desc-preproc_bold.h5')
+    build_store(store_fn, join(base_dir, 'derivatives', 'fmriprep'),
+                task_meta, event_meta, space=space, suffix='.func.gii')